@@ -15,6 +15,7 @@ class TestConfig(object):
   SECRET_KEY = "tototiti"
   SALT = "retwis"
   WHOOSH_BASE = "whoosh"
+  IMAGE_CACHE_DIR = None
 
   def __init__(self):
     db_uri = os.environ.get('SQLALCHEMY_DATABASE_URI')
@@ -0,0 +1,266 @@
+"""
+Test the activity service and feeds.
+"""
+
+import json
+
+from yaka.core.subjects import User, Group
+from yaka.services import activity_service
+from yaka.services import activity as activity_module
+from yaka.services.activity import ActivityEntry, TimelineEntry, \
+  load_objects, FANOUT_LIMIT
+from yaka.web.activity import activity
+
+from .base import IntegrationTestCase
+
+
+class ActivityTestCase(IntegrationTestCase):
+
+  def setUp(self):
+    IntegrationTestCase.setUp(self)
+    activity_service.start()
+    self.user = User(first_name=u"John", email=u"john@example.com")
+    self.session.add(self.user)
+    self.session.flush()
+
+  def tearDown(self):
+    if activity_service.running:
+      activity_service.stop()
+    IntegrationTestCase.tearDown(self)
+
+  def test_load_objects(self):
+    group = Group(name=u"Group")
+    self.session.add(group)
+    self.session.flush()
+    group_id = group.id
+    activity_service.log_activity(None, self.user, "post", group)
+    activity_service.log_activity(None, self.user, "join", self.user,
+                                  subject=group)
+    self.session.commit()
+    self.session.expunge_all()
+
+    entries = load_objects(ActivityEntry.query.order_by(ActivityEntry.id)
+                           .all())
+    self.assertEquals([u"Group", u"John"],
+                      [unicode(e.object) for e in entries])
+    self.assertEquals([None, group_id],
+                      [e.subject and e.subject.id for e in entries])
+
+  def test_timeline(self):
+    paul = User(first_name=u"Paul", email=u"paul@example.com")
+    george = User(first_name=u"George", email=u"george@example.com")
+    self.session.add_all([paul, george])
+    self.session.flush()
+    paul.follow(self.user)
+    self.session.flush()
+    self.assertEquals([paul], self.user.followers)
+
+    for i in range(3):
+      activity_service.log_activity(None, self.user, "post", paul)
+    activity_service.log_activity(None, george, "post", paul)
+    self.session.commit()
+
+    john_entries = ActivityEntry.query.filter(
+      ActivityEntry.actor_id == self.user.id).order_by(ActivityEntry.id).all()
+    timeline = activity_service.timeline_for(paul, limit=2)
+    self.assertEquals([e.id for e in john_entries[:0:-1]],
+                      [e.id for e in timeline])
+    timeline = activity_service.timeline_for(paul, before=timeline[-1].id)
+    self.assertEquals([john_entries[0].id], [e.id for e in timeline])
+    self.assertEquals(1, len(activity_service.timeline_for(george)))
+
+    # John and Paul have 3 entries each.
+    self.assertEquals(4, activity_service.trim_timelines(size=1))
+    self.assertEquals([john_entries[-1].id],
+                      [e.id for e in activity_service.timeline_for(paul)])
+
+  def test_pulled_actors(self):
+    paul = User(first_name=u"Paul", email=u"paul@example.com")
+    george = User(first_name=u"George", email=u"george@example.com")
+    self.session.add_all([paul, george])
+    self.session.flush()
+    paul.follow(self.user)
+    activity_service.fanout_limit = 1
+    try:
+      activity_service.log_activity(None, self.user, "post", paul)
+      self.session.commit()
+      george.follow(self.user)
+      for i in range(2):
+        activity_service.log_activity(None, self.user, "post", george)
+      self.session.commit()
+    finally:
+      activity_service.fanout_limit = FANOUT_LIMIT
+
+    ids = [e.id for e in ActivityEntry.query.order_by(ActivityEntry.id)]
+    # Only the first entry was fanned out to Paul.
+    self.assertEquals(1, TimelineEntry.query.filter(
+      TimelineEntry.user_id == paul.id).count())
+    timeline = activity_service.timeline_for(paul, limit=2)
+    self.assertEquals(ids[:0:-1], [e.id for e in timeline])
+    timeline = activity_service.timeline_for(paul, before=ids[1])
+    self.assertEquals(ids[:1], [e.id for e in timeline])
+    # Including entries from before George followed John.
+    self.assertEquals(ids[::-1], [e.id for e in
+                                  activity_service.timeline_for(george)])
+    self.assertEquals(ids[::-1], [e.id for e in
+                                  activity_service.timeline_for(self.user)])
+
+  def test_queries(self):
+    group = Group(name=u"Group")
+    paul = User(first_name=u"Paul", email=u"paul@example.com")
+    self.session.add_all([group, paul])
+    self.session.flush()
+    for i in range(3):
+      activity_service.log_activity(None, self.user, "post", group)
+    activity_service.log_activity(None, paul, "join", paul, subject=group)
+    self.session.commit()
+    ids = [e.id for e in ActivityEntry.query.order_by(ActivityEntry.id)]
+
+    entries = activity_service.entries_for_actor(self.user, 2)
+    self.assertEquals(ids[2:0:-1], [e.id for e in entries])
+    entries = activity_service.entries_for_actor(self.user,
+                                                 before=entries[-1].id)
+    self.assertEquals(ids[:1], [e.id for e in entries])
+
+    entries = activity_service.entries_for_object(group)
+    self.assertEquals(ids[2::-1], [e.id for e in entries])
+    entries = activity_service.entries_for_subject(group)
+    self.assertEquals(ids[3:], [e.id for e in entries])
+    self.assertEquals(group, entries[0].subject)
+    entries = activity_service.recent_entries(before=ids[3])
+    self.assertEquals(ids[2::-1], [e.id for e in entries])
+
+  def test_aggregation(self):
+    group = Group(name=u"Group")
+    self.session.add(group)
+    self.session.flush()
+    activity_service.aggregation_window = 60
+    try:
+      for i in range(3):
+        activity_service.log_activity(None, self.user, "update", group)
+      activity_service.log_activity(None, self.user, "join", group)
+      self.session.commit()
+      activity_service.log_activity(None, self.user, "update", group)
+      self.session.commit()
+    finally:
+      activity_service.aggregation_window = 0
+
+    entries = ActivityEntry.query.order_by(ActivityEntry.id).all()
+    self.assertEquals([("update", 4), ("join", 1)],
+                      [(e.verb, e.count) for e in entries])
+
+  def test_rollback(self):
+    activity_service.log_activity(None, self.user, "post", self.user)
+    self.session.rollback()
+    self.session.commit()
+    self.assertEquals(0, ActivityEntry.query.count())
+
+  def test_savepoints(self):
+    activity_service.log_activity(None, self.user, "post", self.user)
+    self.session.begin_nested()
+    activity_service.log_activity(None, self.user, "join", self.user)
+    self.session.rollback()
+    self.session.begin_nested()
+    activity_service.log_activity(None, self.user, "leave", self.user)
+    self.session.commit()
+    self.assertEquals(0, ActivityEntry.query.count())
+    self.session.commit()
+    self.assertEquals(["post", "leave"],
+                      [e.verb for e in
+                       ActivityEntry.query.order_by(ActivityEntry.id)])
+
+  def test_write_errors(self):
+    write_entries = activity_module.write_entries
+    def failing_write(*args):
+      raise IOError("database gone")
+    activity_module.write_entries = failing_write
+    try:
+      activity_service.log_activity(None, self.user, "post", self.user)
+      self.session.commit()
+    finally:
+      activity_module.write_entries = write_entries
+    # The session is still usable.
+    self.assertEquals(0, ActivityEntry.query.count())
+
+
+class ActivityFeedTestCase(IntegrationTestCase):
+
+  def create_app(self):
+    app = IntegrationTestCase.create_app(self)
+    app.register_blueprint(activity)
+    return app
+
+  def setUp(self):
+    IntegrationTestCase.setUp(self)
+    activity_service.start()
+
+  def tearDown(self):
+    if activity_service.running:
+      activity_service.stop()
+    IntegrationTestCase.tearDown(self)
+
+  def test_feeds(self):
+    user = User(first_name=u"John", email=u"john@example.com")
+    group = Group(name=u"Group")
+    self.session.add_all([user, group])
+    self.session.flush()
+    activity_service.log_activity(None, user, "post", group)
+    self.session.commit()
+    user_id, group_id = user.id, group.id
+
+    response = self.client.get("/activity/actors/%d" % user_id)
+    self.assert_200(response)
+    feed = json.loads(response.data)
+    self.assertEquals(1, feed['totalItems'])
+    item = feed['items'][0]
+    self.assertEquals("post", item['verb'])
+    self.assertEquals(u"John", item['actor']['displayName'])
+    self.assertEquals(u"Group", item['object']['displayName'])
+    since = feed['since']
+
+    etag = response.headers['ETag']
+    response = self.client.get("/activity/actors/%d?since=%d"
+                               % (user_id, since),
+                               headers={'If-None-Match': etag})
+    self.assert_status(response, 304)
+
+    activity_service.log_activity(None, user, "join", group)
+    self.session.commit()
+    response = self.client.get("/activity/objects/Group/%d?since=%d"
+                               % (group_id, since),
+                               headers={'If-None-Match': etag})
+    self.assert_200(response)
+    self.assertEquals(["join"],
+                      [i['verb'] for i in json.loads(response.data)['items']])
+
+    self.assert_404(self.client.get("/activity/objects/Nothing/1"))
+
+  def test_polling(self):
+    user = User(first_name=u"John", email=u"john@example.com")
+    self.session.add(user)
+    self.session.flush()
+    activity_service.log_activity(None, user, "post", user)
+    self.session.commit()
+    user_id = user.id
+    url = "/activity/actors/%d" % user_id
+    response = self.client.get(url)
+    since = json.loads(response.data)['since']
+    etag = response.headers['ETag']
+
+    for verb in ("a", "b", "c"):
+      activity_service.log_activity(None, user, verb, user)
+    self.session.commit()
+
+    # Pages of new entries, oldest first.
+    verbs = []
+    while True:
+      response = self.client.get("%s?since=%d&limit=2" % (url, since),
+                                 headers={'If-None-Match': etag})
+      if response.status_code == 304:
+        break
+      feed = json.loads(response.data)
+      verbs += [item['verb'] for item in feed['items']]
+      since = feed.get('since', since)
+      etag = response.headers['ETag']
+    self.assertEquals(["a", "b", "c"], verbs)
+
@@ -0,0 +1,57 @@
+"""
+Test the admin views.
+"""
+
+from yaka.core.subjects import User
+from yaka.services import audit_service
+from yaka.web.admin import admin
+
+from .base import IntegrationTestCase
+
+
+class AdminTestCase(IntegrationTestCase):
+
+  def create_app(self):
+    app = IntegrationTestCase.create_app(self)
+    app.register_blueprint(admin)
+    return app
+
+  def test_conversion_stats(self):
+    response = self.client.get("/admin/conversion/stats")
+    self.assert_200(response)
+    assert 'cache_hit_ratio' in response.json
+
+  def test_recent_changes(self):
+    audit_service.start()
+    try:
+      user = User(first_name=u"John", email=u"john@example.com")
+      self.session.add(user)
+      self.session.commit()
+    finally:
+      audit_service.stop()
+
+    response = self.client.get("/admin/audit/recent")
+    self.assert_200(response)
+    entries = response.json['entries']
+    self.assertEquals("User", entries[0]['entity_class'])
+    self.assertEquals("/social/users/%d" % user.id, entries[0]['entity_url'])
+
+  def test_export_audit(self):
+    audit_service.start()
+    try:
+      for i in range(3):
+        self.session.add(User(first_name=u"J\xe9r\xf4me %d" % i,
+                              email=u"%d@example.com" % i))
+        self.session.commit()
+    finally:
+      audit_service.stop()
+
+    response = self.client.get("/admin/audit/export?entity_class=User")
+    self.assert_200(response)
+    lines = response.data.splitlines()
+    assert lines[0].startswith("id,happened_at,type")
+    self.assertEquals(4, len(lines))
+
+    response = self.client.get("/admin/audit/export?format=jsonl&start=2000-01-01")
+    self.assertEquals(3, len(response.data.splitlines()))
+    self.assert_400(self.client.get("/admin/audit/export?start=yesterday"))
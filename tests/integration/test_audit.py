@@ -1,9 +1,16 @@
 import datetime
-from sqlalchemy import Column, Unicode, UnicodeText, Text, Date
+import os
+import pickle
+import shutil
+import tempfile
+from decimal import Decimal
+from sqlalchemy import Column, Unicode, UnicodeText, Text, Date, event
 
 from yaka.services import audit_service
-from yaka.services.audit import AuditEntry, CREATION, UPDATE, DELETION
+from yaka.services.audit import AuditEntry, CREATION, UPDATE, DELETION, \
+  migrate_changes, dump_changes, load_changes, iter_entries
 from yaka.core.entities import Entity, SEARCHABLE, AUDITABLE_HIDDEN
+from yaka.core.extensions import db
 
 from .base import IntegrationTestCase
 
@@ -65,7 +72,8 @@ class TestAudit(IntegrationTestCase):
 
     # content hiding
     account.password = u'new super secret password'
-    assert account.__changes__ == {u'password': (u'******', u'******')}
+    assert audit_service.changes_for(account) == \
+      {u'password': (u'******', u'******')}
     self.session.commit()
 
     entry = AuditEntry.query.order_by(AuditEntry.happened_at).all()[3]
@@ -85,3 +93,232 @@ class TestAudit(IntegrationTestCase):
     assert entry.entity_id == account.id
 
 
+
+  def test_changes_format(self):
+    changes = {u'birthday': (None, datetime.date(2012, 12, 25)),
+               u'seen': (datetime.datetime(2013, 1, 1, 10, 0, 0, 5), None),
+               u'amount': (Decimal("1.10"), u"caf\xe9")}
+    self.assertEquals(changes, load_changes(dump_changes(changes)))
+
+  def test_migrate_changes(self):
+    changes = {u'website': (u'', u'http://www.john.com/')}
+    for i in range(3):
+      self.session.add(AuditEntry(type=UPDATE, entity_class="DummyAccount",
+                                  entity_id=i,
+                                  changes_pickle=pickle.dumps(changes)))
+    self.session.commit()
+    entry = AuditEntry.query.filter(AuditEntry.type == UPDATE).first()
+    assert entry.changes == changes
+
+    self.assertEquals(3, migrate_changes(batch_size=2))
+    self.session.expunge_all()
+    for entry in AuditEntry.query.filter(AuditEntry.type == UPDATE).all():
+      assert entry.changes_pickle is None
+      assert entry.changes == changes
+
+  def test_entries_for(self):
+    account = DummyAccount(name=u"John SARL")
+    self.session.add(account)
+    self.session.flush()
+    for i in range(4):
+      account.website = u"http://www.john.com/%d" % i
+      self.session.flush()
+
+    entries = audit_service.entries_for(account, limit=3)
+    self.assertEquals([UPDATE] * 3, [e.type for e in entries])
+    self.assertEquals(u'http://www.john.com/3', entries[0].changes['website'][1])
+
+    entries = audit_service.entries_for(account, before=entries[-1].id,
+                                        limit=3)
+    self.assertEquals([UPDATE, CREATION], [e.type for e in entries])
+    assert entries[0].to_dict()['type'] == "update"
+
+
+class TestBufferedAudit(IntegrationTestCase):
+
+  def create_app(self):
+    # The writer thread needs to see the same database.
+    self.tmp_dir = tempfile.mkdtemp()
+    app = IntegrationTestCase.create_app(self)
+    app.config['SQLALCHEMY_DATABASE_URI'] = \
+      "sqlite:///" + os.path.join(self.tmp_dir, "test.db")
+    app.config['AUDIT_WRITER'] = 'thread'
+    app.config['AUDIT_SPOOL_FILE'] = os.path.join(self.tmp_dir, "spool")
+    audit_service.init_app(app)
+    # pysqlite's own transaction handling breaks savepoints.
+    engine = db.get_engine(app)
+    event.listen(engine, "connect",
+                 lambda connection, record:
+                   setattr(connection, "isolation_level", None))
+    event.listen(engine, "begin",
+                 lambda connection: connection.execute("BEGIN"))
+    return app
+
+  def setUp(self):
+    IntegrationTestCase.setUp(self)
+    audit_service.start()
+
+  def tearDown(self):
+    if audit_service.running:
+      audit_service.stop()
+    IntegrationTestCase.tearDown(self)
+    shutil.rmtree(self.tmp_dir)
+
+  def test_buffered_writes(self):
+    writer = audit_service.writer
+
+    account = DummyAccount(name=u"John SARL")
+    self.session.add(account)
+    self.session.flush()
+    self.session.rollback()
+    writer.flush()
+    assert AuditEntry.query.count() == 0
+
+    account = DummyAccount(name=u"John SARL")
+    self.session.add(account)
+    self.session.commit()
+    writer.flush()
+    entry = AuditEntry.query.one()
+    assert entry.type == CREATION
+    assert entry.entity_id == account.id
+    assert not os.path.exists(writer.spool_file)
+
+  def test_savepoints(self):
+    writer = audit_service.writer
+
+    self.session.add(DummyAccount(name=u"John SARL"))
+    self.session.flush()
+    self.session.begin_nested()
+    self.session.add(DummyAccount(name=u"Paul SARL"))
+    self.session.commit()
+    self.session.rollback()
+    writer.flush()
+    assert AuditEntry.query.count() == 0
+
+    self.session.add(DummyAccount(name=u"John SARL"))
+    self.session.flush()
+    self.session.begin_nested()
+    self.session.add(DummyAccount(name=u"Paul SARL"))
+    self.session.flush()
+    self.session.rollback()
+    self.session.commit()
+    writer.flush()
+    assert AuditEntry.query.count() == 1
+
+  def test_write_errors(self):
+    writer = audit_service.writer
+    def failing_put(rows):
+      raise IOError("disk full")
+    writer.put = failing_put
+    try:
+      self.session.add(DummyAccount(name=u"John SARL"))
+      self.session.commit()
+    finally:
+      del writer.put
+    assert AuditEntry.query.count() == 0
+    assert os.path.exists(writer.spool_file + ".failed")
+
+    # Written when the service starts again.
+    self.session.commit()
+    audit_service.stop()
+    audit_service.start()
+    audit_service.writer.flush()
+    assert AuditEntry.query.count() == 1
+
+
+class TestAuditArchive(IntegrationTestCase):
+
+  def create_app(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    app = IntegrationTestCase.create_app(self)
+    app.config['AUDIT_RETENTION_MONTHS'] = 3
+    app.config['AUDIT_ARCHIVE_DIR'] = self.tmp_dir
+    audit_service.init_app(app)
+    return app
+
+  def setUp(self):
+    audit_service.start()
+    IntegrationTestCase.setUp(self)
+
+  def tearDown(self):
+    IntegrationTestCase.tearDown(self)
+    if audit_service.running:
+      audit_service.stop()
+    shutil.rmtree(self.tmp_dir)
+
+  def test_archive(self):
+    account = DummyAccount(name=u"John SARL")
+    self.session.add(account)
+    self.session.flush()
+    for i in range(3):
+      account.website = u"http://www.john.com/%d" % i
+      self.session.flush()
+    self.session.commit()
+
+    entries = AuditEntry.query.filter(AuditEntry.entity_id == account.id)\
+      .order_by(AuditEntry.id).all()
+    self.assertEquals(4, len(entries))
+    old = datetime.datetime(2010, 1, 15)
+    for i, entry in enumerate(entries[:3]):
+      entry.happened_at = old + datetime.timedelta(days=30 * i)
+    self.session.commit()
+
+    self.assertEquals(3, audit_service.archive_entries(batch_size=2))
+    self.assertEquals(1, AuditEntry.query.filter(
+      AuditEntry.entity_id == account.id).count())
+    assert os.path.exists(os.path.join(self.tmp_dir,
+                                       "audit-2010-01.jsonl.gz"))
+    archive = audit_service.archive
+    path = archive.path(old)
+    assert archive.is_indexed(path)
+    key = archive.index_key("DummyAccount", account.id)
+    self.assertEquals([0], archive.lookup(path, key))
+    self.assertEquals([], archive.lookup(path,
+                                         archive.index_key("Nothing", 0)))
+
+    entries = audit_service.entries_for(account, limit=3)
+    self.assertEquals([UPDATE, UPDATE, UPDATE], [e.type for e in entries])
+    self.assertEquals(u'http://www.john.com/0',
+                      entries[2].changes['website'][1])
+    entries = audit_service.entries_for(account, before=entries[-1].id)
+    self.assertEquals([CREATION], [e.type for e in entries])
+
+    # Exports include archived entries.
+    entries = list(iter_entries(entity_class="DummyAccount"))
+    self.assertEquals(["creation", "update", "update", "update"],
+                      [e['type'] for e in entries])
+    entries = list(iter_entries(start=datetime.datetime(2010, 2, 1),
+                                end=datetime.datetime(2010, 3, 1)))
+    self.assertEquals([u'http://www.john.com/0'],
+                      [e['changes']['website'][1] for e in entries])
+
+  def test_archive_index(self):
+    account = DummyAccount(name=u"John SARL")
+    self.session.add(account)
+    self.session.flush()
+    for i in range(3):
+      account.website = u"http://www.john.com/%d" % i
+      self.session.flush()
+    self.session.commit()
+
+    old = datetime.datetime(2010, 1, 15)
+    entries = AuditEntry.query.filter(AuditEntry.entity_id == account.id)\
+      .order_by(AuditEntry.id)
+    for i, entry in enumerate(entries):
+      entry.happened_at = old + datetime.timedelta(hours=i)
+    self.session.commit()
+
+    archive = audit_service.archive
+    path = archive.path(old)
+    key = archive.index_key("DummyAccount", account.id)
+    cutoff = old + datetime.timedelta(hours=2)
+    self.assertEquals(2, archive.archive(cutoff, batch_size=1))
+    self.assertEquals(2, len(archive.lookup(path, key)))
+
+    # Line left incomplete by an interrupted run.
+    with open(archive.index_path(path), "ab") as fd:
+      fd.write(key[:5])
+    cutoff += datetime.timedelta(hours=2)
+    self.assertEquals(2, archive.archive(cutoff, batch_size=2))
+    self.assertEquals(3, len(archive.lookup(path, key)))
+    self.assertEquals(4, len(archive.rows_for("DummyAccount", account.id)))
@@ -0,0 +1,80 @@
+"""
+Test the photo views.
+"""
+
+from cStringIO import StringIO
+
+from PIL import Image
+
+from yaka.application import Application
+from yaka.core.subjects import User, update_photo_digests
+from yaka.services import image
+from yaka.web.photos import photos
+
+from .base import IntegrationTestCase
+from .config import TestConfig
+
+
+class PhotosTestCase(IntegrationTestCase):
+
+  def create_app(self):
+    app = IntegrationTestCase.create_app(self)
+    app.register_blueprint(photos)
+    return app
+
+  def test_user_photo(self):
+    output = StringIO()
+    Image.new("RGB", (100, 80), (0, 0, 255)).save(output, "JPEG")
+    user = User(first_name=u"John", email=u"john@example.com",
+                photo=output.getvalue())
+    self.session.add(user)
+    self.session.commit()
+    assert user.photo_digest
+    user_id = user.id
+
+    self.session.expunge_all()
+    user = User.query.get(user_id)
+    assert 'photo' not in user.__dict__
+
+    response = self.client.get("/photos/users/%d?s=32" % user_id)
+    self.assert_200(response)
+    self.assertEquals("image/jpeg", response.mimetype)
+    self.assertEquals((32, 32), Image.open(StringIO(response.data)).size)
+
+    etag = response.headers['ETag']
+    response = self.client.get("/photos/users/%d?s=32" % user_id,
+                               headers={'If-None-Match': etag})
+    self.assert_status(response, 304)
+
+    response = self.client.get("/photos/users/0")
+    self.assert_404(response)
+
+  def test_missing_digests(self):
+    output = StringIO()
+    Image.new("RGB", (10, 10), (0, 0, 255)).save(output, "JPEG")
+    users = [User(first_name=u"John", email=u"john%d@example.com" % i,
+                  photo=output.getvalue()) for i in range(3)]
+    self.session.add_all(users)
+    self.session.commit()
+    user_ids = [user.id for user in users]
+    # As for photos stored before photo_digest was added.
+    table = User.__table__
+    self.session.execute(table.update().values(photo_digest=None,
+                                               photo_updated_at=None))
+    self.session.commit()
+
+    response = self.client.get("/photos/users/%d" % user_ids[0])
+    self.assert_200(response)
+    self.assertEquals(2, update_photo_digests(batch_size=1))
+    self.assertEquals(0, update_photo_digests())
+    self.session.expunge_all()
+    assert all(User.query.get(id).photo_digest for id in user_ids)
+
+  def test_image_settings(self):
+    config = TestConfig()
+    config.IMAGE_CACHE_DIR = "/tmp/yaka-images"
+    try:
+      Application(config)
+      self.assertEquals("/tmp/yaka-images", image.cache.directory)
+    finally:
+      image.cache.directory = None
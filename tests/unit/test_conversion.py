@@ -0,0 +1,329 @@
+# coding=utf-8
+import os
+import shutil
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from yaka.core.signals import conversion_metric
+from yaka.services.conversion import Converter, Cache, Handler, \
+  ConversionError, ConversionTimeout, FileHandler, ToolProcess, \
+  PdfToPpmHandler, iter_ppm_images, mime_sniffer, COMPRESSED_MAGIC
+from yaka.services.conversion_batch import warm_up, iter_manifest, \
+  extract_metadata
+
+DUMMY_FILES = os.path.join(os.path.dirname(__file__), "..", "dummy_files")
+
+
+class FakeHandler(Handler):
+
+  def convert(self, blob, **kw):
+    return "%s>%s" % (blob, self.produces_mime_types[0])
+
+
+class WordToPdf(FakeHandler):
+  accepts_mime_types = ['application/msword']
+  produces_mime_types = ['application/pdf']
+
+
+class ImageToPdf(FakeHandler):
+  accepts_mime_types = ['image/.*']
+  produces_mime_types = ['application/pdf']
+
+
+class PdfToText(FakeHandler):
+  accepts_mime_types = ['application/pdf']
+  produces_mime_types = ['text/plain']
+
+
+class PdfToImages(FakeHandler):
+  accepts_mime_types = ['application/pdf']
+  produces_mime_types = ['image/jpeg']
+  multiple_outputs = True
+
+
+class PdfToPages(FakeHandler):
+  accepts_mime_types = ['application/pdf']
+  produces_mime_types = ['image/jpeg']
+  multiple_outputs = True
+
+  def convert(self, blob, size=500, max_pages=None):
+    pages = ["%s:%d" % (size, i) for i in range(blob.count("page"))]
+    return pages[:max_pages]
+
+
+class ConverterChainTestCase(TestCase):
+
+  def setUp(self):
+    self.converter = Converter()
+    self.converter.register_handler(WordToPdf())
+    self.converter.register_handler(ImageToPdf())
+    self.converter.register_handler(PdfToText())
+
+  def test_handler_accept(self):
+    handler = ImageToPdf()
+    assert handler.accept("image/png", "application/pdf")
+    assert not handler.accept("image/png", "text/plain")
+    assert not handler.accept("application/msword", "application/pdf")
+
+  def test_direct_chain(self):
+    chain = self.converter.find_chain("application/pdf", "text/plain")
+    self.assertEquals([PdfToText], [type(h) for h, _ in chain])
+
+  def test_multi_step_chain(self):
+    chain = self.converter.find_chain("image/png", "text/plain")
+    self.assertEquals([ImageToPdf, PdfToText], [type(h) for h, _ in chain])
+    self.assertEquals(["application/pdf", "text/plain"], [m for _, m in chain])
+
+  def test_convert_through_chain(self):
+    digest = Converter.digest("test_convert_through_chain")
+    text = self.converter.to_text(digest, "blob", "application/msword")
+    self.assertEquals("blob>application/pdf>text/plain", text)
+    # Intermediate PDF went to the cache
+    self.assertEquals("blob>application/pdf",
+                      self.converter.cache["pdf:" + digest])
+
+  def test_no_chain(self):
+    assert self.converter.find_chain("text/plain", "image/jpeg") is None
+    with self.assertRaises(ConversionError):
+      self.converter.to_image("", "blob", "text/plain", 0)
+
+  def test_multiple_outputs_are_terminal(self):
+    self.converter.register_handler(PdfToImages())
+    chain = self.converter.find_chain("application/msword", "image/jpeg")
+    self.assertEquals([WordToPdf, PdfToImages], [type(h) for h, _ in chain])
+    # Not PdfToImages then ImageToPdf.
+    assert self.converter.find_chain("application/pdf",
+                                     "application/pdf") is None
+
+    class JpegToGif(FakeHandler):
+      accepts_mime_types = ['image/jpeg']
+      produces_mime_types = ['image/gif']
+    self.converter.register_handler(JpegToGif())
+    assert self.converter.find_chain("application/pdf", "image/gif") is None
+
+  def test_page_series_to_file(self):
+    with self.assertRaises(ConversionError):
+      PdfToPpmHandler().convert_to_file("in.pdf", "out.jpg")
+
+  def test_chains_are_memoized(self):
+    chain = self.converter.find_chain("application/msword", "text/plain")
+    assert self.converter.find_chain("application/msword", "text/plain") is chain
+
+    self.converter.register_handler(WordToPdf())
+    assert self.converter.find_chain("application/msword", "text/plain") \
+      is not chain
+
+
+class DigestTestCase(TestCase):
+
+  def test_legacy_cache_entries(self):
+    converter = Converter()
+    blob = "some text content"
+    legacy_digest = Converter.digest(blob)
+    converter.cache["txt:" + legacy_digest] = u"cached text"
+
+    digest = converter.upgrade_digest(StringIO(blob))
+    self.assertEquals(digest, Converter.digest_file(StringIO(blob)))
+    assert "txt:" + digest in converter.cache
+    self.assertEquals(u"cached text", converter.cache["txt:" + digest])
+
+
+class PpmStreamTestCase(TestCase):
+
+  def test_iter_ppm_images(self):
+    pages = ("P6\n2 1\n255\n" + "\xff\x00\x00" * 2
+             + "P6\n# comment\n1 2 255\n" + "\x00\x00\xff" * 2)
+    images = list(iter_ppm_images(StringIO(pages)))
+    self.assertEquals([(2, 1), (1, 2)], [img.size for img in images])
+    self.assertEquals((0, 0, 255), images[1].getpixel((0, 1)))
+
+  def test_truncated_stream(self):
+    with self.assertRaises(ConversionError):
+      list(iter_ppm_images(StringIO("P6\n2 2\n255\n\x00\x00")))
+
+
+class StatsTestCase(TestCase):
+
+  def setUp(self):
+    self.converter = Converter()
+    # Misses on every run.
+    self.cache_dir = mkdtemp()
+    self.converter.cache = Cache(self.cache_dir)
+    self.converter.register_handler(WordToPdf())
+    self.converter.register_handler(PdfToText())
+
+  def tearDown(self):
+    shutil.rmtree(self.cache_dir)
+
+  def test_metrics(self):
+    sent = []
+    def receiver(sender, **kw):
+      sent.append((kw['kind'], kw['name']))
+    conversion_metric.connect(receiver)
+
+    try:
+      digest = Converter.digest("test_metrics")
+      self.converter.to_text(digest, "blob", "application/msword")
+      self.converter.to_text(digest, "blob", "application/msword")
+    finally:
+      conversion_metric.disconnect(receiver)
+
+    stats = self.converter.stats
+    self.assertEquals(0.5, stats.cache_hit_ratio("text"))
+    self.assertEquals(1, stats.get("handler.success", handler="WordToPdf",
+                                   target="application/pdf"))
+    self.assertEquals(len("blob>application/pdf>text/plain"),
+                      stats.get("handler.bytes_out", handler="PdfToText",
+                                target="text/plain"))
+    assert ("timing", "handler.latency") in sent
+
+    d = stats.to_dict()
+    self.assertEquals({"text": 0.5}, d['cache_hit_ratio'])
+    self.assertEquals(2, len(d['timings']))
+    self.assertEquals(["+Inf", 1], d['timings'][0]['buckets'][-1])
+
+
+class SleepyHandler(FileHandler):
+  accepts_mime_types = ['application/msword']
+  produces_mime_types = ['text/plain']
+  run_timeout = 0.2
+
+  def convert_file(self, in_fn, **kw):
+    # The shell forks: its child must be killed too.
+    return self.run(['sh', '-c', 'sleep 30; echo done'])
+
+
+class ToolProcessTestCase(TestCase):
+
+  def test_failure(self):
+    with self.assertRaises(ConversionError):
+      ToolProcess(['sh', '-c', 'exit 3']).communicate()
+    with self.assertRaises(ConversionError):
+      ToolProcess(['no-such-conversion-tool']).communicate()
+
+  def test_timeout(self):
+    converter = Converter()
+    converter.register_handler(SleepyHandler())
+    digest = Converter.digest("test_timeout")
+    grace_period = ToolProcess.grace_period
+    ToolProcess.grace_period = 0.2
+    try:
+      with self.assertRaises(ConversionTimeout):
+        converter.to_text(digest, "blob", "application/msword")
+    finally:
+      ToolProcess.grace_period = grace_period
+
+    tags = dict(handler="SleepyHandler", target="text/plain")
+    self.assertEquals(1, converter.stats.get("handler.killed", **tags))
+    self.assertEquals(1, converter.stats.get("handler.timeout", **tags))
+
+
+class WarmUpTestCase(TestCase):
+
+  def setUp(self):
+    self.tmp_dir = mkdtemp()
+    self.converter = Converter()
+    self.converter.cache = Cache(os.path.join(self.tmp_dir, "cache"))
+    self.converter.register_handler(WordToPdf())
+    self.converter.register_handler(PdfToText())
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def test_warm_up_is_resumable(self):
+    lines = []
+    for i in range(3):
+      path = os.path.join(self.tmp_dir, "doc%d" % i)
+      with open(path, "wb") as fd:
+        fd.write("doc%d" % i)
+      digest = Converter.digest("test_warm_up:%d" % i)
+      lines.append("%s %s application/msword" % (digest, path))
+    state_file = os.path.join(self.tmp_dir, "state")
+
+    items = iter_manifest(lines[:2])
+    summary = warm_up(items, converter=self.converter, targets=("text",),
+                      state_file=state_file, report=lambda s: None)
+    self.assertEquals(2, summary['converted'])
+    self.assertEquals(u"doc0>application/pdf>text/plain",
+                      self.converter.cache["txt:" + lines[0].split()[0]])
+
+    items = iter_manifest(lines)
+    summary = warm_up(items, converter=self.converter, targets=("text",),
+                      state_file=state_file, report=lambda s: None)
+    self.assertEquals(1, summary['total'])
+    self.assertEquals(1, summary['converted'])
+
+
+  def test_warm_up_previews(self):
+    self.converter.register_handler(PdfToPages())
+    lines = []
+    for i, content in enumerate(["page", "page page page"]):
+      path = os.path.join(self.tmp_dir, "doc%d" % i)
+      with open(path, "wb") as fd:
+        fd.write(content)
+      digest = Converter.digest("test_warm_up_previews:%d" % i)
+      lines.append("%s %s application/msword" % (digest, path))
+
+    def run(pages):
+      return warm_up(iter_manifest(lines), converter=self.converter,
+                     targets=("image",), pages=pages, report=lambda s: None)
+    self.assertEquals(2, run(1)['converted'])
+    # More previews are needed.
+    self.assertEquals(2, run(2)['converted'])
+    self.assertEquals(1, self.converter.page_count(lines[0].split()[0]))
+    self.assertEquals(0, run(2)['converted'])
+
+
+class CacheTestCase(TestCase):
+
+  def test_compressed_text(self):
+    cache = Converter().cache
+    key = "txt:" + Converter.digest("test_compressed_text")
+    text = u"Some text été " * 100
+    cache[key] = text
+    raw = open(cache.get_path(key), "rb").read()
+    assert raw.startswith(COMPRESSED_MAGIC)
+    assert len(raw) < len(text)
+    self.assertEquals(text, cache[key])
+
+  def test_legacy_entry(self):
+    cache = Converter().cache
+    key = "txt:" + Converter.digest("test_legacy_entry")
+    with open(cache.new_path(key), "wb") as fd:
+      fd.write(u"été".encode("utf8"))
+    self.assertEquals(u"été", cache[key])
+
+
+class SnifferTestCase(TestCase):
+
+  def test_threads(self):
+    path = os.path.join(DUMMY_FILES, "picture.jpg")
+    pool = ThreadPool(4)
+    try:
+      mime_types = pool.map(mime_sniffer.from_file, [path] * 20)
+    finally:
+      pool.close()
+    self.assertEquals(["image/jpeg"] * 20, mime_types)
+
+
+class MetadataTestCase(TestCase):
+
+  def test_cached_metadata(self):
+    converter = Converter()
+    path = os.path.join(DUMMY_FILES, "picture.jpg")
+    content = open(path, "rb").read()
+    digest = Converter.digest(content)
+    if "meta:" + digest in converter.cache:
+      os.remove(converter.cache.get_path("meta:" + digest))
+
+    metadata = converter.get_metadata(digest, content, "image/jpeg")
+    self.assertEquals(1, converter.stats.get("cache.miss", target="meta"))
+    self.assertEquals(metadata,
+                      converter.get_metadata(digest, content, "image/jpeg"))
+    self.assertEquals(1, converter.stats.get("cache.hit", target="meta"))
+
+    result = extract_metadata([(digest, path, "image/jpeg")],
+                              converter=converter)
+    self.assertEquals({digest: metadata}, result)
@@ -0,0 +1,88 @@
+import shutil
+from cStringIO import StringIO
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from PIL import Image
+from werkzeug.datastructures import MIMEAccept
+
+from yaka.services import image
+from yaka.services.image import ImageCache
+
+
+def make_jpeg(width, height):
+  output = StringIO()
+  Image.new("RGB", (width, height), (255, 0, 0)).save(output, "JPEG")
+  return output.getvalue()
+
+
+class ImageCacheTestCase(TestCase):
+
+  def setUp(self):
+    self.directory = mkdtemp()
+    # Fresh module cache for each test.
+    self.previous_cache = image.cache
+    image.cache = ImageCache(self.directory)
+
+  def tearDown(self):
+    image.cache = self.previous_cache
+    shutil.rmtree(self.directory)
+
+  def test_lru_by_size(self):
+    cache = ImageCache(max_bytes=10)
+    cache.set("a", "x" * 4)
+    cache.set("b", "x" * 4)
+    cache.get("a")
+    cache.set("c", "x" * 4)
+    self.assertEquals(8, cache.size)
+    assert "a" in cache and "c" in cache
+    assert "b" not in cache
+
+  def test_disk(self):
+    cache = ImageCache(self.directory, max_bytes=10)
+    cache.set("abc", "x" * 20)
+    self.assertEquals(0, cache.size)
+    self.assertEquals("x" * 20, ImageCache(self.directory).get("abc"))
+
+  def test_resize(self):
+    small = make_jpeg(50, 20)
+    self.assertEquals(small, image.resize(small, 100))
+    assert image.cache.size == len(small)
+
+    big = make_jpeg(200, 100)
+    resized = Image.open(StringIO(image.resize(big, 100)))
+    self.assertEquals((100, 50), resized.size)
+    cropped = Image.open(StringIO(image.crop_and_resize(big, 100)))
+    self.assertEquals((100, 100), cropped.size)
+
+  def test_thumbnails(self):
+    big = make_jpeg(1600, 1200)
+    results = image.thumbnails(big, [(32, 32), (100, 0), (400, 100)])
+    sizes = [Image.open(StringIO(data)).size for data in results]
+    self.assertEquals([(32, 32), (100, 75), (400, 100)], sizes)
+
+    draft = image.decode(Image.open(StringIO(big)), 1600 / 100.0)
+    self.assertEquals((200, 150), draft.size)
+
+    # Re-encoded at full size, not from the draft.
+    results = image.thumbnails(big, [(32, 32), (2000, 0)], format="PNG")
+    self.assertEquals((1600, 1200), Image.open(StringIO(results[1])).size)
+
+  def test_formats(self):
+    output = StringIO()
+    Image.new("RGBA", (200, 100), (255, 0, 0, 0)).save(output, "PNG")
+    png = output.getvalue()
+    thumbnail = image.resize(png, 100)
+    self.assertEquals("image/png", image.mime_type(thumbnail))
+    self.assertEquals("RGBA", Image.open(StringIO(thumbnail)).mode)
+
+    thumbnail = image.resize(png, 100, format="JPEG", quality=50)
+    self.assertEquals("image/jpeg", image.mime_type(thumbnail))
+    self.assertEquals((255, 255, 255),
+                      Image.open(StringIO(thumbnail)).getpixel((50, 25)))
+
+  def test_negotiate_format(self):
+    self.assertEquals(None, image.negotiate_format(MIMEAccept([("*/*", 1)])))
+    accept = MIMEAccept([("image/webp", 1), ("*/*", 0.8)])
+    expected = "WEBP" if "WEBP" in image.supported_formats() else None
+    self.assertEquals(expected, image.negotiate_format(accept))
@@ -1,7 +1,9 @@
 # coding=utf-8
+import hashlib
+from cStringIO import StringIO
 from unittest import TestCase
 
-from yaka.core.util import Pagination, slugify
+from yaka.core.util import Pagination, slugify, new_hash, stream_digest
 
 
 class TestPagination(TestCase):
@@ -38,3 +40,19 @@ class TestSlugify(TestCase):
     slug = slugify(u"C'est l'été")
     assert slug == 'c-est-l-ete'
     assert isinstance(slug, str)
+
+
+class TestStreamDigest(TestCase):
+
+  def test_chunks(self):
+    data = "0123456789" * 1000
+    digest = stream_digest(StringIO(data), chunk_size=7)
+    assert digest == new_hash(data).hexdigest()
+    assert len(digest) == 32
+    assert digest != hashlib.md5(data).hexdigest()
+
+  def test_legacy(self):
+    data = "some content"
+    digest, legacy = stream_digest(StringIO(data), legacy=True)
+    assert digest == new_hash(data).hexdigest()
+    assert legacy == hashlib.md5(data).hexdigest()
@@ -8,7 +8,8 @@ from flask import Flask, g, request
 from yaka.core.extensions import mail, db, celery, babel
 from yaka.web.filters import init_filters
 
-from yaka.services import audit_service, index_service, activity_service
+from yaka.services import audit_service, index_service, activity_service, \
+  image
 
 
 __all__ = ['create_app', 'Application', 'ServiceManager']
@@ -25,6 +26,7 @@ class ServiceManager(object):
     audit_service.init_app(self)
     index_service.init_app(self)
     activity_service.init_app(self)
+    image.init_app(self)
 
   def start_services(self):
     audit_service.start()
@@ -0,0 +1,134 @@
+"""
+Flask-Script commands for Yaka applications.
+
+Add them to your application's manager, ex::
+
+  manager.add_command("warm_conversion_cache", WarmConversionCache())
+  manager.add_command("migrate_audit_changes", MigrateAuditChanges())
+  manager.add_command("archive_audit_entries", ArchiveAuditEntries())
+  manager.add_command("trim_activity_timelines", TrimActivityTimelines())
+  manager.add_command("update_photo_digests", UpdatePhotoDigests())
+"""
+
+import sys
+
+from flask.ext.script import Command, Option
+
+from yaka.core.subjects import update_photo_digests
+from yaka.services import activity_service, audit, conversion_batch
+
+
+__all__ = ['WarmConversionCache', 'MigrateAuditChanges', 'ArchiveAuditEntries',
+           'TrimActivityTimelines', 'UpdatePhotoDigests']
+
+
+class WarmConversionCache(Command):
+  """
+  Pre-warms the conversion cache: PDF, text and page previews of all the files
+  under a directory, or of the documents listed in a manifest file (lines of
+  "digest path [mime_type]").
+  """
+
+  option_list = (
+    Option('-d', '--directory', dest='directory',
+           help="Convert all the files under this directory"),
+    Option('-m', '--manifest', dest='manifest',
+           help='Manifest file ("-" for stdin)'),
+    Option('-t', '--targets', dest='targets', default="pdf,text,image",
+           help="Comma-separated list of: pdf, text, image"),
+    Option('-p', '--pages', dest='pages', type=int, default=1,
+           help="Number of page previews to render"),
+    Option('-s', '--size', dest='size', type=int, default=500,
+           help="Width of page previews"),
+    Option('-w', '--workers', dest='workers', type=int, default=4),
+    Option('--state', dest='state_file',
+           help="File recording processed documents, to resume interrupted "
+                "runs"),
+  )
+
+  def run(self, directory=None, manifest=None, targets="pdf,text,image",
+          pages=1, size=500, workers=4, state_file=None):
+    if bool(directory) == bool(manifest):
+      print >> sys.stderr, "One of --directory or --manifest is required"
+      sys.exit(1)
+
+    if directory:
+      items = conversion_batch.iter_directory(directory)
+    elif manifest == "-":
+      items = conversion_batch.iter_manifest(sys.stdin)
+    else:
+      items = conversion_batch.iter_manifest(open(manifest))
+
+    def report(summary):
+      print conversion_batch.format_summary(summary)
+      sys.stdout.flush()
+
+    targets = [t.strip() for t in targets.split(",") if t.strip()]
+    summary = conversion_batch.warm_up(items, targets=targets, pages=pages,
+                                       size=size, workers=workers,
+                                       state_file=state_file, report=report)
+    if summary['failed']:
+      sys.exit(2)
+
+
+class MigrateAuditChanges(Command):
+  """
+  Converts the changes of audit entries from the legacy (pickle) format.
+  Runs in batches, and can be interrupted and resumed.
+  """
+
+  option_list = (
+    Option('-b', '--batch-size', dest='batch_size', type=int, default=1000),
+  )
+
+  def run(self, batch_size=1000):
+    count = audit.migrate_changes(batch_size=batch_size)
+    print "%d audit entries converted" % count
+
+
+class ArchiveAuditEntries(Command):
+  """
+  Moves old audit entries (see the AUDIT_RETENTION_MONTHS setting) to
+  compressed archives in AUDIT_ARCHIVE_DIR.
+  """
+
+  option_list = (
+    Option('-m', '--months', dest='months', type=int,
+           help="Archive entries older than this number of months"),
+    Option('-b', '--batch-size', dest='batch_size', type=int, default=1000),
+  )
+
+  def run(self, months=None, batch_size=1000):
+    count = audit.audit_service.archive_entries(months=months,
+                                                batch_size=batch_size)
+    print "%d audit entries archived" % count
+
+
+class TrimActivityTimelines(Command):
+  """
+  Removes the oldest entries of user timelines longer than
+  ACTIVITY_TIMELINE_SIZE (or --size).
+  """
+
+  option_list = (
+    Option('-s', '--size', dest='size', type=int),
+  )
+
+  def run(self, size=None):
+    count = activity_service.trim_timelines(size=size)
+    print "%d timeline entries removed" % count
+
+
+class UpdatePhotoDigests(Command):
+  """
+  Computes the missing digests of user and group photos (photos stored
+  before they were introduced), which are needed to serve them.
+  """
+
+  option_list = (
+    Option('-b', '--batch-size', dest='batch_size', type=int, default=100),
+  )
+
+  def run(self, batch_size=100):
+    count = update_photo_digests(batch_size=batch_size)
+    print "%d photo digests computed" % count
@@ -21,7 +21,8 @@ from .extensions import db
 from .util import memoized
 
 
-__all__ = ['Entity', 'all_entity_classes', 'db', 'ValidationError']
+__all__ = ['Entity', 'all_entity_classes', 'entity_class_by_name', 'db',
+           'ValidationError']
 
 
 class Info(dict):
@@ -231,6 +232,16 @@ def all_entity_classes():
            if isclass(cls) and issubclass(cls, Entity) ]
 
 
+def entity_class_by_name(name):
+  """
+  Returns the persistent Entity subclass named `name`, or `None`.
+  """
+  cls = Entity._decl_class_registry.get(name)
+  if isclass(cls) and issubclass(cls, Entity):
+    return cls
+  return None
+
+
 def register_all_entity_classes():
   for cls in all_entity_classes():
     register_metadata(cls)
@@ -18,3 +18,8 @@ entity_deleted = signals.signal("entity:deleted")
 #user_deleted = signals.signal("user:deleted")
 
 activity = signals.signal("activity")
+
+#: Sent by the conversion service for each metric it records, with `kind`
+#: ("counter" or "timing"), `name`, `value` and `tags` (a dict) arguments.
+#: Connect to it to forward metrics to StatsD, Prometheus...
+conversion_metric = signals.signal("conversion:metric")
@@ -11,12 +11,14 @@ from datetime import datetime, timedelta
 
 from flask.ext.login import UserMixin
 
-from sqlalchemy.orm import relationship
+from sqlalchemy import event
+from sqlalchemy.orm import relationship, deferred
 from sqlalchemy.orm.query import Query
 from sqlalchemy.schema import Column, Table, ForeignKey, UniqueConstraint
 from sqlalchemy.types import Integer, UnicodeText, LargeBinary, Boolean, DateTime, Text
 
 from .entities import db, Entity, SEARCHABLE, SYSTEM
+from .util import new_hash
 
 
 __all__ = ['User', 'Group', 'Principal']
@@ -81,7 +83,10 @@ class User(Principal, UserMixin, Entity):
   password = Column(UnicodeText, default=u"*",
                     info={'audit_hide_content': True,})
 
-  photo = Column(LargeBinary)
+  # Deferred: photos are only loaded when accessed (see yaka.web.photos).
+  photo = deferred(Column(LargeBinary))
+  photo_digest = Column(Text, info=SYSTEM)
+  photo_updated_at = Column(DateTime, info=SYSTEM)
 
   last_active = Column(DateTime, info=SYSTEM)
 
@@ -206,7 +211,9 @@ class Group(Entity, Principal):
                          backref='groups')
   admins = relationship("User", secondary=administratorship)
 
-  photo = Column(LargeBinary)
+  photo = deferred(Column(LargeBinary))
+  photo_digest = Column(Text, info=SYSTEM)
+  photo_updated_at = Column(DateTime, info=SYSTEM)
 
   public = Column(Boolean, default=False, nullable=False)
 
@@ -214,3 +221,62 @@ class Group(Entity, Principal):
   @property
   def _url(self):
     return "/social/groups/%d" % self.id
+
+
+def photo_set_listener(target, value, old_value, initiator):
+  """Keeps `photo_digest` and `photo_updated_at` in sync with `photo`, so
+  that photos can be served (and cached) without being loaded."""
+  if value:
+    target.photo_digest = new_hash(value).hexdigest()
+    target.photo_updated_at = datetime.utcnow()
+  else:
+    target.photo_digest = None
+    target.photo_updated_at = None
+
+event.listen(User.photo, 'set', photo_set_listener)
+event.listen(Group.photo, 'set', photo_set_listener)
+
+
+def update_photo_digests(batch_size=100, session=None):
+  """Computes the missing `photo_digest` (and `photo_updated_at`) of users
+  and groups, e.g. for photos stored before these columns were added,
+  `batch_size` photos per transaction. Can be interrupted and run again.
+
+  Returns the number of updated users and groups.
+  """
+  session = session or db.session
+  count = 0
+  for cls in (User, Group):
+    table = cls.__table__
+    last_id = -1
+    while True:
+      rows = session.execute(
+        table.select()
+        .with_only_columns([table.c.id, table.c.photo])
+        .where(table.c.id > last_id)
+        .where(table.c.photo_digest == None)
+        .where(table.c.photo != None)
+        .order_by(table.c.id)
+        .limit(batch_size)).fetchall()
+      if not rows:
+        break
+
+      for id, photo in rows:
+        set_photo_digest(cls, id, photo, session)
+      session.commit()
+      count += len(rows)
+      last_id = rows[-1][0]
+  return count
+
+
+def set_photo_digest(cls, id, photo, session=None):
+  """Stores the digest of `photo`, the photo of the `cls` (User or Group)
+  whose id is `id`. Returns `(photo_digest, photo_updated_at)`."""
+  session = session or db.session
+  table = cls.__table__
+  digest = new_hash(photo).hexdigest()
+  updated_at = datetime.utcnow()
+  session.execute(table.update()
+                  .where(table.c.id == id)
+                  .values(photo_digest=digest, photo_updated_at=updated_at))
+  return digest, updated_at
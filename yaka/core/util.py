@@ -3,6 +3,7 @@ Various tools that don't belong some place specific.
 """
 
 import functools
+import hashlib
 import logging
 import time
 from math import ceil
@@ -11,6 +12,12 @@ import re
 
 from flask import request
 
+try:
+  from hashlib import blake2b
+except ImportError:
+  # Required: digests must not depend on what happens to be installed.
+  from pyblake2 import blake2b
+
 
 def get_params(names):
   """
@@ -79,7 +86,69 @@ class memoized(object):
     return functools.partial(self.__call__, obj)
 
 
+#: Size of the chunks read by :func:`stream_digest`.
+DIGEST_CHUNK_SIZE = 1024 * 1024
+
+
+def new_hash(data=""):
+  """
+  Returns a new hash object for content digests: BLAKE2b (from `hashlib` on
+  Python 3.6+, from the `pyblake2` dependency otherwise).
+
+  Digests are 16 bytes long, so they fit where MD5 digests used to be stored.
+  """
+  if isinstance(data, unicode):
+    data = data.encode("utf8")
+  return blake2b(data, digest_size=16)
+
+
+def stream_digest(source, legacy=False, chunk_size=DIGEST_CHUNK_SIZE):
+  """
+  Returns the hex digest (see :func:`new_hash`) of `source`, a path or a file
+  object, read in chunks so that the whole content never sits in memory.
+
+  If `legacy` is True, returns a `(digest, md5_digest)` tuple computed in the
+  same pass.
+  """
+  if isinstance(source, basestring):
+    with open(source, "rb") as fd:
+      return stream_digest(fd, legacy=legacy, chunk_size=chunk_size)
+
+  hashes = [new_hash()]
+  if legacy:
+    hashes.append(hashlib.md5())
+
+  while True:
+    chunk = source.read(chunk_size)
+    if not chunk:
+      break
+    if isinstance(chunk, unicode):
+      chunk = chunk.encode("utf8")
+    for h in hashes:
+      h.update(chunk)
+
+  digests = tuple(h.hexdigest() for h in hashes)
+  return digests if legacy else digests[0]
+
+
 # From http://flask.pocoo.org/snippets/44/
+def outer_transaction(transaction):
+  """The savepoint or outermost transaction which `transaction` (a
+  :class:`SessionTransaction`) belongs to, i.e. the one that actually
+  commits or rolls back its changes."""
+  while transaction._parent is not None and not transaction.nested:
+    transaction = transaction._parent
+  return transaction
+
+
+def is_within(transaction, ancestor):
+  while transaction is not None:
+    if transaction is ancestor:
+      return True
+    transaction = transaction._parent
+  return False
+
+
 class Pagination(object):
 
   def __init__(self, page, per_page, total_count):
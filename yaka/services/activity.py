@@ -4,20 +4,62 @@ Activity Service.
 See: http://activitystrea.ms/specs/json/1.0/
 See: http://activitystrea.ms/specs/atom/1.0/#activity
 See: http://stackoverflow.com/questions/1443960/how-to-implement-the-activity-stream-in-a-social-network
+
+Activities are buffered in the session, and written in bulk once (and if) its
+transaction is committed. Repeated activities (same actor, verb, object and
+subject) logged within :attr:`ActivityService.aggregation_window` seconds
+are stored as a single entry with a :attr:`ActivityEntry.count`.
+
+Entries are fanned out on write to the timelines of the followers of their
+actor (and of the actor itself), so that :meth:`ActivityService.timeline_for`
+reads a single indexed table. Timelines are capped to
+:attr:`ActivityService.timeline_size` entries by
+:meth:`ActivityService.trim_timelines`.
+
+Entries of actors with more than :attr:`ActivityService.fanout_limit`
+followers aren't fanned out: these actors are recorded in the
+`activity_pulled_actor` table, and :meth:`ActivityService.timeline_for` merges
+their entries at read time.
 """
 
-from datetime import datetime
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+from weakref import WeakKeyDictionary
 
-from sqlalchemy.orm import relationship
-from sqlalchemy.schema import Column, ForeignKey
+from sqlalchemy import event, func
+from sqlalchemy.orm import relationship, joinedload
+from sqlalchemy.orm.session import Session
+from sqlalchemy.schema import Column, ForeignKey, Index, Table
+from sqlalchemy.sql.expression import bindparam, select, and_, or_
 from sqlalchemy.types import Integer, DateTime, Text
 
-from yaka.core.entities import db, all_entity_classes
+from yaka.core.entities import db, entity_class_by_name
 from yaka.core.signals import activity
-from yaka.core.subjects import User
+from yaka.core.subjects import User, following
+from yaka.core.util import outer_transaction, is_within
+
+
+logger = logging.getLogger(__name__)
+
+#: Default number of entries returned by :meth:`ActivityService.timeline_for`
+#: and the other queries.
+PAGE_SIZE = 50
+
+#: Default maximum number of entries kept in each timeline.
+TIMELINE_SIZE = 1000
+
+#: Default maximum number of followers for entries to be fanned out.
+FANOUT_LIMIT = 1000
+
+# Columns identifying repeated activities.
+AGGREGATION_KEY = ('actor_id', 'verb', 'object_class', 'object_id',
+                   'subject_class', 'subject_id')
+
+# Marks entries whose object / subject hasn't been loaded yet.
+NOT_LOADED = object()
 
 
-# TODO: review the design as it hits the DB with too many requests.
 class ActivityEntry(db.Model):
   """Main table for all activities."""
 
@@ -35,20 +77,224 @@ class ActivityEntry(db.Model):
   subject_class = Column(Text)
   subject_id = Column(Integer)
 
+  #: Number of aggregated activities (see ActivityService.aggregation_window).
+  count = Column(Integer, default=1, nullable=False)
+
+  # Set by load_objects(), or on first access to `object` / `subject`.
+  _object = NOT_LOADED
+  _subject = NOT_LOADED
+
   def __repr__(self):
     return "<ActivityEntry id=%s actor=%s verb=%s object=%s subject=%s>" % (
       self.id, self.actor, self.verb, "TODO", "TODO")
 
+  def to_dict(self):
+    """Activity Streams (JSON) representation. Objects and subjects should
+    have been loaded with :func:`load_objects`."""
+    if self._object is NOT_LOADED:
+      load_objects([self])
+    data = dict(id=tag_uri("activity", self.id),
+                published=self.happened_at.isoformat() + "Z",
+                verb=self.verb,
+                actor=as_object(self.actor),
+                object=as_object(self._object, self.object_class,
+                                 self.object_id))
+    if self.subject_class:
+      data['target'] = as_object(self._subject, self.subject_class,
+                                 self.subject_id)
+    if self.count > 1:
+      data['count'] = self.count
+    return data
+
   @property
   def object(self):
-    for cls in all_entity_classes():
-      if cls.__name__ == self.object_class:
-        return cls.query.get(self.object_id)
-    raise Exception("Unknown class: %s" % self.object_class)
+    """The object of the activity. Use :func:`load_objects` to load the
+    objects and subjects of many entries at once."""
+    if self._object is NOT_LOADED:
+      if entity_class_by_name(self.object_class) is None:
+        raise Exception("Unknown class: %s" % self.object_class)
+      load_objects([self])
+    return self._object
+
+  @property
+  def subject(self):
+    if self._subject is NOT_LOADED:
+      load_objects([self])
+    return self._subject
+
+
+# Queries (see ActivityService._page).
+Index('activity_entry_actor_idx', ActivityEntry.actor_id,
+      ActivityEntry.happened_at)
+Index('activity_entry_object_idx', ActivityEntry.object_class,
+      ActivityEntry.object_id, ActivityEntry.happened_at)
+Index('activity_entry_subject_idx', ActivityEntry.subject_class,
+      ActivityEntry.subject_id, ActivityEntry.happened_at)
+Index('activity_entry_happened_at_idx', ActivityEntry.happened_at)
+
+
+def tag_uri(class_name, id):
+  """Identifier of an object in activity streams."""
+  return "urn:yaka:%s:%s" % (class_name.lower(), id)
+
+
+def as_object(object, class_name=None, id=None):
+  """Activity Streams representation of an `object` (entity or user), which
+  may be `None` if it doesn't exist anymore."""
+  if object is not None:
+    class_name = object.__class__.__name__
+    id = object.id
+  elif class_name is None:
+    return None
+  data = dict(objectType=class_name.lower(), id=tag_uri(class_name, id))
+  if object is not None:
+    data['displayName'] = unicode(object)
+  return data
+
+
+class TimelineEntry(db.Model):
+  """An activity entry in the timeline of a user."""
+
+  user_id = Column(Integer, ForeignKey(User.id), primary_key=True)
+  entry_id = Column(Integer, ForeignKey(ActivityEntry.id), primary_key=True)
+
+
+# Actors whose entries aren't fanned out. Rows may be duplicated (no unique
+# constraint, so that concurrent writers don't fail).
+pulled_actor = Table(
+  'activity_pulled_actor', db.Model.metadata,
+  Column('user_id', Integer, ForeignKey(User.id), nullable=False, index=True))
+
+# Followers of actors (fan-out), followees of users (timeline_for).
+Index('following_follower_idx', following.c.follower_id)
+Index('following_followee_idx', following.c.followee_id)
+
+
+def follower_ids(connection, actor_ids):
+  """Returns `(actor id, follower id)` pairs for `actor_ids`."""
+  # Rows of `following` are (followee, follower) pairs despite the column
+  # names: see the User.followers relationship.
+  query = select([following.c.follower_id, following.c.followee_id])\
+    .where(following.c.follower_id.in_(actor_ids))
+  return connection.execute(query).fetchall()
+
+
+def pulled_actor_ids(connection, actor_ids, limit=None):
+  """Returns the ids of the actors among `actor_ids` whose entries aren't
+  fanned out. With a `limit`, actors with more followers than that are
+  recorded as such first."""
+  query = select([pulled_actor.c.user_id])\
+    .where(pulled_actor.c.user_id.in_(actor_ids))
+  pulled = set(user_id for user_id, in connection.execute(query))
+  others = [actor_id for actor_id in actor_ids if actor_id not in pulled]
+  if limit is None or not others:
+    return pulled
+
+  # Rows of `following` are (followee, follower) pairs, see follower_ids().
+  query = select([following.c.follower_id])\
+    .where(following.c.follower_id.in_(others))\
+    .group_by(following.c.follower_id)\
+    .having(func.count(following.c.followee_id) > limit)
+  new = [user_id for user_id, in connection.execute(query)]
+  if new:
+    connection.execute(pulled_actor.insert(),
+                       [dict(user_id=user_id) for user_id in new])
+    pulled.update(new)
+  return pulled
+
+
+def fan_out(connection, entries, limit=None):
+  """Adds `entries`, a list of `(entry id, actor id)` pairs, to the timelines
+  of their actor and of its followers, unless it has more than `limit`
+  followers (see :func:`pulled_actor_ids`)."""
+  actor_ids = set(actor_id for _, actor_id in entries if actor_id is not None)
+  if not actor_ids:
+    return
+  pushed = actor_ids - pulled_actor_ids(connection, list(actor_ids), limit)
+  followers = defaultdict(set)
+  if pushed:
+    for actor_id, follower_id in follower_ids(connection, list(pushed)):
+      followers[actor_id].add(follower_id)
+
+  rows = []
+  for entry_id, actor_id in entries:
+    if actor_id is None:
+      continue
+    for user_id in followers[actor_id] | set([actor_id]):
+      rows.append(dict(user_id=user_id, entry_id=entry_id))
+  connection.execute(TimelineEntry.__table__.insert(), rows)
+
+
+def write_entries(connection, rows, window=0, fanout_limit=None):
+  """Inserts `rows` (column values of new entries), and adds them to
+  timelines (see :func:`fan_out` for `fanout_limit`).
+
+  With a `window` (in seconds), rows repeating an entry (see
+  :data:`AGGREGATION_KEY`) logged at most `window` seconds before are merged
+  into it instead: its count is increased and its `happened_at` updated.
+  """
+  table = ActivityEntry.__table__
+  inserted = []
+  merged = []
+  for row in rows:
+    if window:
+      since = row['happened_at'] - timedelta(seconds=window)
+      query = select([table.c.id])\
+        .where(and_(*[table.c[key] == row[key] for key in AGGREGATION_KEY]))\
+        .where(table.c.happened_at >= since)\
+        .order_by(table.c.happened_at.desc()).limit(1)
+      entry_id = connection.execute(query).scalar()
+      if entry_id is not None:
+        merged.append(dict(entry_id=entry_id, added=row['count'],
+                           at=row['happened_at']))
+        continue
+    result = connection.execute(table.insert(), row)
+    inserted.append((result.inserted_primary_key[0], row['actor_id']))
+
+  if merged:
+    update = table.update()\
+      .where(table.c.id == bindparam('entry_id'))\
+      .values(count=table.c.count + bindparam('added'),
+              happened_at=bindparam('at'))
+    connection.execute(update, merged)
+  fan_out(connection, inserted, fanout_limit)
+
+
+def load_objects(entries, chunk_size=500):
+  """Loads the objects and subjects of `entries` with one query per class
+  (and per `chunk_size` entities). Objects of unknown classes, or which
+  don't exist anymore, are `None`."""
+  ids_by_class = defaultdict(set)
+  for entry in entries:
+    if entry.object_class and entry.object_id is not None:
+      ids_by_class[entry.object_class].add(entry.object_id)
+    if entry.subject_class and entry.subject_id is not None:
+      ids_by_class[entry.subject_class].add(entry.subject_id)
+
+  loaded = {}
+  for class_name, ids in ids_by_class.items():
+    cls = entity_class_by_name(class_name)
+    if cls is None:
+      continue
+    ids = sorted(ids)
+    for i in range(0, len(ids), chunk_size):
+      query = cls.query.filter(cls.id.in_(ids[i:i + chunk_size]))
+      for entity in query.all():
+        loaded[(class_name, entity.id)] = entity
+
+  for entry in entries:
+    entry._object = loaded.get((entry.object_class, entry.object_id))
+    entry._subject = loaded.get((entry.subject_class, entry.subject_id))
+  return entries
 
 
 class ActivityService(object):
 
+  listening = False
+  timeline_size = TIMELINE_SIZE
+  fanout_limit = FANOUT_LIMIT
+  aggregation_window = 0
+
   def __init__(self, app=None):
     self.running = False
     if app:
@@ -56,11 +302,26 @@ class ActivityService(object):
 
   def init_app(self, app):
     self.app = app
+    self.timeline_size = app.config.get('ACTIVITY_TIMELINE_SIZE',
+                                        TIMELINE_SIZE)
+    self.fanout_limit = app.config.get('ACTIVITY_FANOUT_LIMIT', FANOUT_LIMIT)
+    # In seconds, 0 to store all activities separately.
+    self.aggregation_window = app.config.get('ACTIVITY_AGGREGATION_WINDOW', 0)
+    # Session => activities logged in its current transaction.
+    self._pending = WeakKeyDictionary()
+    # Session => rows to write once its transaction is committed.
+    self._rows = WeakKeyDictionary()
 
   def start(self):
     assert not self.running
     activity.connect(self.log_activity)
     self.running = True
+    # Session events can't be removed.
+    if not self.listening:
+      event.listen(Session, "before_commit", self.before_commit)
+      event.listen(Session, "after_commit", self.after_commit)
+      event.listen(Session, "after_rollback", self.after_rollback)
+      self.listening = True
 
   def stop(self):
     assert self.running
@@ -68,18 +329,198 @@ class ActivityService(object):
     self.running = False
 
   def log_activity(self, sender, actor, verb, object, subject=None):
+    """Logs an activity, written when the current transaction is
+    committed."""
     assert self.running
-    entry = ActivityEntry()
-    entry.actor = actor
-    entry.verb = verb
-    entry.object_id = object.id
-    entry.object_class = object.__class__.__name__
-    if subject:
-      entry.subject_id = subject.id
-      entry.subject_class = subject.__class__.__name__
-
-    db.session.add(entry)
-
-  @staticmethod
-  def entries_for_actor(actor, limit=50):
-    return ActivityEntry.query.filter(ActivityEntry.actor_id == actor.id).limit(limit).all()
+    session = db.session()
+    activities = self._pending.setdefault(session, [])
+    activities.append((outer_transaction(session.transaction),
+                       actor, verb, object, subject, datetime.utcnow()))
+
+  def before_commit(self, session):
+    # Savepoints: activities are written with the outermost transaction.
+    if session.transaction.nested:
+      return
+    activities = self._pending.pop(session, None)
+    if not activities:
+      return
+    # Assigns ids to new actors, objects and subjects.
+    session.flush()
+
+    rows = self._rows.setdefault(session, [])
+    # Aggregation key => last row.
+    latest = {}
+    for _, actor, verb, object, subject, happened_at in activities:
+      row = dict(actor_id=actor.id if actor else None, verb=verb,
+                 object_class=object.__class__.__name__, object_id=object.id,
+                 subject_class=subject.__class__.__name__ if subject else None,
+                 subject_id=subject.id if subject else None,
+                 happened_at=happened_at, count=1)
+      key = tuple(row[k] for k in AGGREGATION_KEY)
+      previous = latest.get(key)
+      if (previous is not None and self.aggregation_window
+          and happened_at - previous['happened_at']
+              <= timedelta(seconds=self.aggregation_window)):
+        previous['count'] += 1
+        previous['happened_at'] = happened_at
+      else:
+        rows.append(row)
+        latest[key] = row
+
+  def after_commit(self, session):
+    if session.transaction.nested:
+      return
+    rows = self._rows.pop(session, None)
+    if not rows:
+      return
+    # Errors would be raised by session.commit(), once the session's own
+    # transaction is committed, and leave the session unusable.
+    try:
+      with db.get_engine(self.app).begin() as connection:
+        write_entries(connection, rows, self.aggregation_window,
+                      self.fanout_limit)
+    except Exception:
+      logger.exception("Can't write %d activity entries: %r",
+                       len(rows), rows)
+
+  def after_rollback(self, session):
+    rolled_back = outer_transaction(session.transaction)
+    if not rolled_back.nested:
+      self._pending.pop(session, None)
+      self._rows.pop(session, None)
+      return
+    # Rolled back to a savepoint: forgets the activities logged since.
+    activities = self._pending.get(session, [])
+    activities[:] = [activity for activity in activities
+                     if not is_within(activity[0], rolled_back)]
+
+  def entries_for_actor(self, actor, limit=PAGE_SIZE, before=None,
+                        since=None):
+    """Activities of `actor`, most recent first, with their `actor`.
+
+    Returns at most `limit` entries (all of them if `limit` is `None`),
+    older than the entry whose id is `before` if given: pass the id of the
+    last entry of a page to get the next one. With `since` (an entry id),
+    entries more recent than this one are returned instead, oldest first:
+    pass the id of the last entry of a page to get the next one, or to poll
+    for new entries.
+    """
+    query = ActivityEntry.query.filter(ActivityEntry.actor_id == actor.id)
+    return self._page(query, before, limit, since)
+
+  def entries_for_object(self, object, limit=PAGE_SIZE, before=None,
+                          since=None):
+    """Activities whose object is `object`. Pagination works as in
+    :meth:`entries_for_actor`."""
+    query = ActivityEntry.query\
+      .filter(ActivityEntry.object_class == object.__class__.__name__)\
+      .filter(ActivityEntry.object_id == object.id)
+    entries = self._page(query, before, limit, since)
+    for entry in entries:
+      entry._object = object
+    return entries
+
+  def entries_for_subject(self, subject, limit=PAGE_SIZE, before=None,
+                          since=None):
+    """Activities whose subject is `subject`. Pagination works as in
+    :meth:`entries_for_actor`."""
+    query = ActivityEntry.query\
+      .filter(ActivityEntry.subject_class == subject.__class__.__name__)\
+      .filter(ActivityEntry.subject_id == subject.id)
+    entries = self._page(query, before, limit, since)
+    for entry in entries:
+      entry._subject = subject
+    return entries
+
+  def recent_entries(self, limit=PAGE_SIZE, before=None, since=None):
+    """Activities of all actors. Pagination works as in
+    :meth:`entries_for_actor`."""
+    return self._page(ActivityEntry.query, before, limit, since)
+
+  def _page(self, query, before, limit, since=None):
+    query = query.options(joinedload(ActivityEntry.actor))
+    # Entries logged together share their happened_at: id breaks ties.
+    if before is not None:
+      before_at = select([ActivityEntry.happened_at])\
+        .where(ActivityEntry.id == before).as_scalar()
+      query = query.filter(or_(
+        ActivityEntry.happened_at < before_at,
+        and_(ActivityEntry.happened_at == before_at,
+             ActivityEntry.id < before)))
+    if since is not None:
+      since_at = select([ActivityEntry.happened_at])\
+        .where(ActivityEntry.id == since).as_scalar()
+      query = query.filter(or_(
+        ActivityEntry.happened_at > since_at,
+        and_(ActivityEntry.happened_at == since_at,
+             ActivityEntry.id > since)))
+
+      query = query.order_by(ActivityEntry.happened_at, ActivityEntry.id)
+    else:
+      query = query.order_by(ActivityEntry.happened_at.desc(),
+                             ActivityEntry.id.desc())
+    if limit is not None:
+      query = query.limit(limit)
+    return query.all()
+
+  def timeline_for(self, user, before=None, limit=PAGE_SIZE):
+    """Activities of `user` and of the users it follows, most recent first
+    (by id), with their `actor`.
+
+    Returns at most `limit` entries, older than the entry whose id is
+    `before` if given: pass the id of the last entry of a page to get the
+    next one.
+    """
+    query = ActivityEntry.query\
+      .join(TimelineEntry, TimelineEntry.entry_id == ActivityEntry.id)\
+      .filter(TimelineEntry.user_id == user.id)\
+      .options(joinedload(ActivityEntry.actor))
+    if before is not None:
+      query = query.filter(TimelineEntry.entry_id < before)
+    query = query.order_by(TimelineEntry.entry_id.desc())
+    entries = query.limit(limit).all()
+
+    # Entries of followed actors which aren't fanned out.
+    pulled = db.session.query(pulled_actor.c.user_id).distinct()\
+      .filter(pulled_actor.c.user_id == following.c.follower_id)\
+      .filter(following.c.followee_id == user.id)
+    pulled_ids = [user_id for user_id, in pulled]
+    if not pulled_ids:
+      return entries
+
+    query = ActivityEntry.query\
+      .filter(ActivityEntry.actor_id.in_(pulled_ids))\
+      .options(joinedload(ActivityEntry.actor))
+    if before is not None:
+      query = query.filter(ActivityEntry.id < before)
+    query = query.order_by(ActivityEntry.id.desc())
+    # Actors pulled after some of their entries were fanned out can have
+    # entries in both lists.
+    merged = dict((entry.id, entry) for entry in query.limit(limit))
+    merged.update((entry.id, entry) for entry in entries)
+    return sorted(merged.values(), key=lambda entry: entry.id,
+                  reverse=True)[:limit]
+
+  def trim_timelines(self, size=None):
+    """Removes the oldest entries of timelines longer than `size` (defaults
+    to the ACTIVITY_TIMELINE_SIZE setting). Returns the number of entries
+    removed."""
+    if size is None:
+      size = self.timeline_size
+    table = TimelineEntry.__table__
+    session = db.session()
+    user_ids = session.query(table.c.user_id)\
+      .group_by(table.c.user_id)\
+      .having(func.count(table.c.entry_id) > size)
+    count = 0
+    for user_id, in user_ids.all():
+      cutoff = session.query(table.c.entry_id)\
+        .filter(table.c.user_id == user_id)\
+        .order_by(table.c.entry_id.desc())\
+        .offset(size).limit(1).scalar()
+      result = session.execute(table.delete()
+                               .where(table.c.user_id == user_id)
+                               .where(table.c.entry_id <= cutoff))
+      count += result.rowcount
+    session.commit()
+    return count
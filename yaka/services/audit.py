@@ -9,27 +9,57 @@ TODO: In the future, we may decide to:
 - Make Entities that have the __auditable__ property set to False not auditable.
 """
 
-from datetime import datetime
+from datetime import datetime, date, time
+from decimal import Decimal
+import gzip
+import hashlib
+import json
+import logging
+import os
 import pickle
+import threading
+import zlib
+from collections import defaultdict
+from Queue import Queue, Empty
+from weakref import WeakKeyDictionary
 from flask import g
 
 from sqlalchemy import event
-from sqlalchemy.orm import relationship
-from sqlalchemy.orm.attributes import NO_VALUE
+from sqlalchemy.orm import relationship, joinedload
+from sqlalchemy.orm.attributes import instance_state, PASSIVE_NO_INITIALIZE
+from sqlalchemy.orm.properties import ColumnProperty
 from sqlalchemy.orm.session import Session
-from sqlalchemy.schema import Column, ForeignKey
-from sqlalchemy.types import Integer, Unicode, DateTime, Text, Binary
+from sqlalchemy.schema import Column, ForeignKey, Index
+from sqlalchemy.sql.expression import bindparam, select, and_, or_
+from sqlalchemy.types import Integer, Unicode, UnicodeText, DateTime, Text, \
+  Binary, String, LargeBinary
 
 from yaka.core.subjects import User
 from yaka.core.entities import Entity, all_entity_classes
-from yaka.core.extensions import db
+from yaka.core.extensions import celery, db
+from yaka.core.util import outer_transaction, is_within
 
+logger = logging.getLogger(__name__)
 
 # TODO: use flufl.enum here
 CREATION = 0
 UPDATE   = 1
 DELETION = 2
 
+#: Default number of entries returned by :meth:`AuditService.entries_for`.
+PAGE_SIZE = 50
+
+TYPE_NAMES = {CREATION: "creation", UPDATE: "update", DELETION: "deletion"}
+
+# Marks entries whose entity hasn't been loaded yet.
+NOT_LOADED = object()
+
+#: Version of the serialization format of :attr:`AuditEntry.changes_json`.
+CHANGES_FORMAT = 1
+
+#: Values longer than this aren't stored in audit entries.
+MAX_VALUE_LENGTH = 1000
+
 class AuditEntry(db.Model):
   """
   Logs modifications to auditable classes.
@@ -46,28 +76,18 @@ class AuditEntry(db.Model):
   user_id = Column(Integer, ForeignKey(User.id))
   user = relationship(User)
 
+  #: Changes, as serialized by :func:`dump_changes`.
+  changes_json = Column(UnicodeText)
+  #: Legacy format (pickle), still read. See :func:`migrate_changes`.
   changes_pickle = Column(Binary)
 
+  _decoded_changes = None
+  # Set by load_entities(), or on first access to `entity`.
+  _entity = NOT_LOADED
+
   @staticmethod
   def from_model(model, type):
-    try:
-      user_id = g.user.id
-    except:
-      user_id = 0
-
-    entry = AuditEntry()
-    entry.type = type
-    entry.entity_id = model.id
-    entry.entity_class = model.__class__.__name__
-    entry.user_id = user_id
-    for attr_name in ('_name', 'path', '__path_before_delete'):
-      if hasattr(model, attr_name):
-        try:
-          entry.entity_name = getattr(model, attr_name)
-        except:
-          raise
-
-    return entry
+    return AuditEntry(**entry_values(model, type, current_user_id()))
 
   def __repr__(self):
     return "<AuditEntry id=%s type=%s user=%s entity=<%s id=%s>>" % (
@@ -78,42 +98,283 @@ class AuditEntry(db.Model):
 
   #noinspection PyTypeChecker
   def get_changes(self):
-    # Using Pickle here instead of JSON because we need to pickle values
-    # such as dates. This could make schema migration more difficult, though.
-    if self.changes_pickle:
-      return pickle.loads(self.changes_pickle)
-    else:
-      return {}
+    # Decoded on first access only.
+    if self._decoded_changes is None:
+      if self.changes_json:
+        self._decoded_changes = load_changes(self.changes_json)
+      elif self.changes_pickle:
+        self._decoded_changes = pickle.loads(self.changes_pickle)
+      else:
+        self._decoded_changes = {}
+    return self._decoded_changes
 
   def set_changes(self, changes):
-    # for strings: store only unicode values
-    uchanges = {}
-    for k, v in changes.iteritems():
-      k = unicode(k)
-      uv = []
-      for val in v:
-        if isinstance(val, str):
-          # TODO: Temp fix for errors that happen during migration
-          try:
-            val = val.decode('utf-8')
-          except:
-            self.app.logger.error("A unicode error happened on changes %s",
-                                  repr(changes))
-            val = u"[[Somme error occurred. Working on it]]"
-        uv.append(val)
-      uchanges[k] = tuple(uv)
-    self.changes_pickle = pickle.dumps(uchanges)
+    self.changes_json = dump_changes(changes)
+    self.changes_pickle = None
+    self._decoded_changes = None
 
   changes = property(get_changes, set_changes)
 
-  # FIXME: extremely innefficient
+  def to_dict(self):
+    """JSON-friendly representation (ex: for "load more" requests)."""
+    return dict(id=self.id,
+                happened_at=self.happened_at.isoformat(),
+                type=TYPE_NAMES[self.type],
+                user_id=self.user_id,
+                user=unicode(self.user) if self.user else None,
+                entity_name=self.entity_name,
+                changes=json_changes(self.changes))
+
   @property
   def entity(self):
-    #noinspection PyTypeChecker
-    if not self.entity_class or not self.entity_id:
-      return None
-    cls = audit_service.model_class_names.get(self.entity_class)
-    return cls.query.get(self.entity_id) if cls is not None else None
+    """The audited entity, `None` if it doesn't exist anymore. Use
+    :func:`load_entities` to load the entities of many entries at once."""
+    if self._entity is NOT_LOADED:
+      load_entities([self])
+    return self._entity
+
+
+# Audit history of an entity, most recent first.
+Index('audit_entry_entity_idx', AuditEntry.entity_class, AuditEntry.entity_id,
+      AuditEntry.happened_at)
+# Archival of old entries.
+Index('audit_entry_happened_at_idx', AuditEntry.happened_at)
+
+
+def load_entities(entries, chunk_size=500):
+  """Loads the entities of `entries` (see :attr:`AuditEntry.entity`) with
+  one query per entity class (and per `chunk_size` entities)."""
+  ids_by_class = defaultdict(set)
+  for entry in entries:
+    if entry.entity_class and entry.entity_id:
+      ids_by_class[entry.entity_class].add(entry.entity_id)
+
+  entities = {}
+  for class_name, ids in ids_by_class.items():
+    cls = audit_service.model_class_names.get(class_name)
+    if cls is None:
+      continue
+    ids = sorted(ids)
+    for i in range(0, len(ids), chunk_size):
+      query = cls.query.filter(cls.id.in_(ids[i:i + chunk_size]))
+      for entity in query.all():
+        entities[(class_name, entity.id)] = entity
+
+  for entry in entries:
+    entry._entity = entities.get((entry.entity_class, entry.entity_id))
+  return entries
+
+
+def json_changes(changes):
+  """`changes` with JSON-friendly values (dates as ISO 8601 strings, etc)."""
+  result = {}
+  for attr, values in changes.items():
+    result[attr] = [v.isoformat() if isinstance(v, (date, time)) else
+                    v if v is None or isinstance(v, (basestring, bool, int,
+                                                     long, float)) else
+                    unicode(v)
+                    for v in values]
+  return result
+
+
+def iter_entries(entity_class=None, user_id=None, start=None, end=None,
+                 batch_size=1000, include_archive=True):
+  """Yields audit entries as dicts (see :meth:`AuditEntry.to_dict`), in
+  chronological order, optionally filtered by entity class, user and date
+  range (`start` included, `end` excluded).
+
+  Entries are read in batches of `batch_size` (keyset pagination), and
+  their changes decoded one at a time: memory use doesn't depend on the
+  number of entries. Archived entries (see :class:`AuditArchive`) of the
+  months in the range come first, unless `include_archive` is False.
+  """
+  archive = audit_service.archive if include_archive else None
+  if archive is not None:
+    for row in archive.iter_rows(start, end):
+      if ((entity_class is None or row['entity_class'] == entity_class)
+          and (user_id is None or row['user_id'] == user_id)
+          and (start is None or row['happened_at'] >= start)
+          and (end is None or row['happened_at'] < end)):
+        yield export_dict(row)
+
+  table = AuditEntry.__table__
+  conditions = []
+  if entity_class is not None:
+    conditions.append(table.c.entity_class == entity_class)
+  if user_id is not None:
+    conditions.append(table.c.user_id == user_id)
+  if start is not None:
+    conditions.append(table.c.happened_at >= start)
+  if end is not None:
+    conditions.append(table.c.happened_at < end)
+
+  last = None
+  while True:
+    query = table.select().order_by(table.c.happened_at, table.c.id)\
+      .limit(batch_size)
+    for condition in conditions:
+      query = query.where(condition)
+    if last is not None:
+      query = query.where(or_(
+        table.c.happened_at > last[0],
+        and_(table.c.happened_at == last[0], table.c.id > last[1])))
+
+    rows = db.session.execute(query).fetchall()
+    if not rows:
+      break
+    for row in rows:
+      yield export_dict(dict(row.items()))
+    last = rows[-1].happened_at, rows[-1].id
+
+
+def export_dict(row):
+  """Dict for :func:`iter_entries` from a row (dict of column values)."""
+  if row.get('changes_json'):
+    changes = load_changes(row['changes_json'])
+  elif row.get('changes_pickle'):
+    changes = pickle.loads(str(row['changes_pickle']))
+  else:
+    changes = {}
+  return dict(id=row['id'],
+              happened_at=row['happened_at'].isoformat(),
+              type=TYPE_NAMES.get(row['type']),
+              user_id=row['user_id'],
+              entity_class=row['entity_class'],
+              entity_id=row['entity_id'],
+              entity_name=row['entity_name'],
+              changes=json_changes(changes))
+
+
+def current_user_id():
+  """Id of the current user, 0 (the system user) if there is none."""
+  try:
+    user = g.user
+  except (AttributeError, RuntimeError):
+    # No user, or not in a request / application context.
+    return 0
+  return getattr(user, 'id', None) or 0
+
+
+def entry_values(model, type, user_id):
+  """Column values of the audit entry for `model`."""
+  values = dict(type=type,
+                entity_id=model.id,
+                entity_class=model.__class__.__name__,
+                user_id=user_id)
+  for attr_name in ('_name', 'path', '__path_before_delete'):
+    if hasattr(model, attr_name):
+      values['entity_name'] = getattr(model, attr_name)
+  return values
+
+
+def dump_changes(changes):
+  """Serializes `changes` for :attr:`AuditEntry.changes_json`: a JSON object
+  `{"v": version, "c": {attribute: [old value, new value]}}`, where dates,
+  times and decimals are encoded as `{"$date": "2012-12-25"}`, etc.
+  """
+  # for strings: store only unicode values
+  uchanges = {}
+  for k, v in changes.iteritems():
+    k = unicode(k)
+    uv = []
+    for val in v:
+      if isinstance(val, str):
+        # TODO: Temp fix for errors that happen during migration
+        try:
+          val = val.decode('utf-8')
+        except UnicodeDecodeError:
+          logger.error("A unicode error happened on changes %s",
+                       repr(changes))
+          val = u"[[Somme error occurred. Working on it]]"
+      uv.append(val)
+    uchanges[k] = uv
+  return unicode(json.dumps({"v": CHANGES_FORMAT, "c": uchanges},
+                            default=_encode_value, ensure_ascii=False,
+                            separators=(',', ':')))
+
+
+def load_changes(data):
+  """Decodes changes serialized by :func:`dump_changes`."""
+  decoded = json.loads(data, object_hook=_decode_value)
+  if decoded.get("v") != CHANGES_FORMAT:
+    raise ValueError("Unknown audit changes format: %r" % decoded.get("v"))
+  return dict((k, tuple(v)) for k, v in decoded["c"].iteritems())
+
+
+def _encode_value(value):
+  if isinstance(value, datetime):
+    if value.tzinfo is not None:
+      return value.isoformat()
+    return {"$datetime": value.isoformat()}
+  elif isinstance(value, date):
+    return {"$date": value.isoformat()}
+  elif isinstance(value, time):
+    if value.tzinfo is not None:
+      return value.isoformat()
+    return {"$time": value.isoformat()}
+  elif isinstance(value, Decimal):
+    return {"$decimal": str(value)}
+  # Anything else is only kept for display.
+  return unicode(value)
+
+
+def _parse_time(value, format):
+  if "." in value:
+    format += ".%f"
+  return datetime.strptime(value, format)
+
+
+_VALUE_DECODERS = {
+  "$datetime": lambda v: _parse_time(v, "%Y-%m-%dT%H:%M:%S"),
+  "$date": lambda v: datetime.strptime(v, "%Y-%m-%d").date(),
+  "$time": lambda v: _parse_time(v, "%H:%M:%S").time(),
+  "$decimal": Decimal,
+}
+
+
+def _decode_value(obj):
+  if len(obj) == 1:
+    key, value = obj.items()[0]
+    decoder = _VALUE_DECODERS.get(key)
+    if decoder is not None:
+      return decoder(value)
+  return obj
+
+
+def migrate_changes(batch_size=1000, session=None):
+  """Converts audit entries from the legacy pickle format, `batch_size`
+  entries per transaction. Can be interrupted and run again.
+
+  Returns the number of converted entries.
+  """
+  session = session or db.session
+  table = AuditEntry.__table__
+  update = table.update()\
+    .where(table.c.id == bindparam('entry_id'))\
+    .values(changes_json=bindparam('json'), changes_pickle=None)
+
+  count = 0
+  last_id = -1
+  while True:
+    rows = session.execute(
+      table.select()
+      .with_only_columns([table.c.id, table.c.changes_pickle])
+      .where(table.c.id > last_id)
+      .where(table.c.changes_pickle != None)
+      .order_by(table.c.id)
+      .limit(batch_size)).fetchall()
+    if not rows:
+      break
+
+    params = [dict(entry_id=id, json=dump_changes(pickle.loads(str(data))))
+              for id, data in rows]
+    session.execute(update, params)
+    session.commit()
+    count += len(rows)
+    last_id = rows[-1][0]
+    logger.info("Converted %d audit entries", count)
+
+  return count
 
 
 class AuditService(object):
@@ -124,12 +385,30 @@ class AuditService(object):
   def __init__(self, app=None):
     self.all_model_classes = set()
     self.model_class_names = {}
+    # class => [(attribute, hide content, may be too long)]
+    self.audited_attributes = {}
     if app is not None:
       self.init_app(self.app)
 
   def init_app(self, app):
     self.app = app
     app.extensions['audit'] = self
+    # How audit entries are written: "sync" (in the flush), or after commit
+    # by a background "thread" or a "celery" task. See AuditWriter.
+    self.writer_mode = app.config.get('AUDIT_WRITER', 'sync')
+    if self.writer_mode not in ('sync', 'thread', 'celery'):
+      raise ValueError("Invalid AUDIT_WRITER: %r" % self.writer_mode)
+    self.writer = None
+    # Rows that can't be written are kept there, and written on start.
+    self.spool_file = app.config.get('AUDIT_SPOOL_FILE')
+    # Session => [(transaction, rows)] waiting for the end of its
+    # transaction.
+    self._pending = WeakKeyDictionary()
+    # Retention: entries older than AUDIT_RETENTION_MONTHS can be moved to
+    # AUDIT_ARCHIVE_DIR (see archive_entries()).
+    self.retention_months = app.config.get('AUDIT_RETENTION_MONTHS')
+    archive_dir = app.config.get('AUDIT_ARCHIVE_DIR')
+    self.archive = AuditArchive(archive_dir) if archive_dir else None
 
   def start(self):
     assert not self.running
@@ -137,16 +416,27 @@ class AuditService(object):
     self.running = True
     self.register_classes()
 
+    if self.writer_mode == 'thread':
+      self.writer = AuditWriter(self.app, self.spool_file)
+      self.writer.start()
+    elif self.writer_mode == 'celery':
+      AuditWriter(self.app, self.spool_file).replay()
+
     # Workaround the fact that we can't stop listening when the service is
     # stopped.
     if not self.listening:
       event.listen(Session, "after_flush", self.create_audit_entries)
+      event.listen(Session, "after_commit", self.after_commit)
+      event.listen(Session, "after_rollback", self.after_rollback)
       self.listening = True
 
   def stop(self):
     assert self.running
     self.app.logger.info("Stopping audit service")
     self.running = False
+    if self.writer is not None:
+      self.writer.stop()
+      self.writer = None
     # One can't currently remove these events.
     #event.remove(Session, "before_commit", self.before_commit)
 
@@ -164,103 +454,594 @@ class AuditService(object):
     assert entity_class.__name__ not in self.model_class_names
     self.model_class_names[entity_class.__name__] = entity_class
 
-    mapper = entity_class.__mapper__
-    for column in mapper.columns:
-      props = mapper.get_property_by_column(column)
-      attr = getattr(entity_class, props.key)
-      info = column.info
-
-      if info.get('auditable', True):
-        #print "I will now audit attribute %s for class %s" % (name, entity_class)
-        event.listen(attr, "set", self.set_attribute)
-
-  def set_attribute(self, entity, new_value, old_value, initiator):
-    attr_name = initiator.key
-    if old_value == new_value:
-      return
+    # Rules are computed once: changes are computed at flush time, from
+    # the attributes history (see changes_for()).
+    attributes = []
+    for prop in entity_class.__mapper__.iterate_properties:
+      if not isinstance(prop, ColumnProperty):
+        continue
+      column = prop.columns[0]
+      if not column.info.get('auditable', True):
+        continue
+      # We can only hide the simplest case: 1 attribute => 1 column
+      hide = (len(prop.columns) == 1
+              and column.info.get('audit_hide_content', False))
+      may_be_long = isinstance(column.type, (String, LargeBinary))
+      attributes.append((prop.key, hide, may_be_long))
+    self.audited_attributes[entity_class] = attributes
 
-    # We don't log a few trivial cases so as not to overflow the audit log.
-    if not old_value and not new_value:
-      return
-    if old_value == NO_VALUE:
-      return
+  def changes_for(self, model):
+    """Changes of the audited attributes of `model` since it was loaded (or
+    last flushed): {attribute: (old value, new value)}."""
+    state = instance_state(model)
+    changes = {}
+    for key, hide, may_be_long in self.audited_attributes.get(
+        model.__class__, ()):
+      history = state.get_history(key, PASSIVE_NO_INITIALIZE)
+      if not history.added:
+        continue
+      if not history.deleted:
+        # Old value unknown (not loaded) or nothing changed.
+        continue
+      old_value, new_value = history.deleted[0], history.added[0]
 
-    #print "set_atttribute called for: %s, key: %s" % (entity, attr_name)
-    #print "old value: %s, new value: %s" % (old_value, new_value)
-    changes = getattr(entity, "__changes__", None)
-    if not changes:
-      changes = entity.__changes__ = {}
-    if changes.has_key(attr_name):
-      old_value = changes[attr_name][0]
-    if old_value == NO_VALUE:
-      old_value = None
-    # FIXME: a bit hackish
-
-    # Hide content if needed (like password columns)
-    # FIXME: we can only handle the simplest case: 1 attribute => 1 column
-    columns = initiator.parent_token.columns
-    if (len(columns) == 1 and
-        columns[0].info.get('audit_hide_content')):
-      old_value = new_value = u'******'
+      # We don't log a few trivial cases so as not to overflow the audit log.
+      if not old_value and not new_value:
+        continue
 
-    try:
-      if len(old_value) > 1000:
-        old_value = "<<large value>>"
-      if len(new_value) > 1000:
-        new_value = "<<large value>>"
-    except:
-      pass
-    changes[attr_name] = (old_value, new_value)
+      if hide:
+        old_value = new_value = u'******'
+      elif may_be_long:
+        if old_value is not None and len(old_value) > MAX_VALUE_LENGTH:
+          old_value = "<<large value>>"
+        if new_value is not None and len(new_value) > MAX_VALUE_LENGTH:
+          new_value = "<<large value>>"
+      changes[key] = (old_value, new_value)
+    return changes
 
   def create_audit_entries(self, session, flush_context):
+    """Inserts the audit entries of the flushed entities, as a single
+    (executemany) insert on the flush's connection: no ORM objects, and no
+    extra flush."""
     if not self.running:
       return
 
-    transaction = session.begin(subtransactions=True)
+    user_id = current_user_id()
+    rows = []
 
     for model in session.new:
-      self.log_new(session, model)
+      self.log_new(rows, model, user_id)
 
     for model in session.deleted:
-      self.log_deleted(session, model)
+      self.log_deleted(rows, model, user_id)
 
     for model in session.dirty:
-      self.log_updated(session, model)
+      self.log_updated(rows, model, user_id)
+
+    if not rows:
+      return
 
-    transaction.commit()
+    happened_at = datetime.utcnow()
+    for row in rows:
+      row['happened_at'] = happened_at
+      # executemany needs the same columns in all rows.
+      row.setdefault('entity_name', None)
+      row.setdefault('changes_json', None)
 
-  def log_new(self, session, model):
-    if not isinstance(model, Entity):
+    if self.writer_mode == 'sync':
+      session.connection().execute(AuditEntry.__table__.insert(), rows)
+    else:
+      # Written after commit, dropped on rollback.
+      self._pending.setdefault(session, []).append(
+        (outer_transaction(session.transaction), rows))
+
+  def after_commit(self, session):
+    # Savepoints: entries are written with the outermost transaction.
+    if session.transaction.nested:
+      return
+    pending = self._pending.pop(session, None)
+    if not pending:
       return
+    rows = [row for _, flushed in pending for row in flushed]
+    # Errors would be raised by session.commit(), once the session's own
+    # transaction is committed.
+    try:
+      if self.writer_mode == 'celery':
+        write_audit_entries.apply_async(kwargs=dict(data=dump_rows(rows)))
+      elif self.writer is not None:
+        self.writer.put(rows)
+      else:
+        # Service stopped in the meantime.
+        insert_rows(db.get_engine(self.app), rows)
+    except Exception:
+      logger.exception("Can't write %d audit entries", len(rows))
+      self.spool_failed(rows)
 
-    entry = AuditEntry.from_model(model, type=CREATION)
-    session.add(entry)
+  def after_rollback(self, session):
+    rolled_back = outer_transaction(session.transaction)
+    if not rolled_back.nested:
+      self._pending.pop(session, None)
+      return
+    # Rolled back to a savepoint: forgets the entries flushed since.
+    pending = self._pending.get(session, [])
+    pending[:] = [(transaction, rows) for transaction, rows in pending
+                  if not is_within(transaction, rolled_back)]
 
-    if hasattr(model, '__changes__'):
-      del model.__changes__
+  def spool_failed(self, rows):
+    """Keeps `rows` in the AUDIT_SPOOL_FILE + ".failed" file, written
+    when the service starts."""
+    if self.spool_file:
+      try:
+        spool_rows(self.spool_file + ".failed", rows)
+        return
+      except IOError:
+        logger.exception("Can't spool %d audit entries", len(rows))
+    logger.error("Lost audit entries: %s", dump_rows(rows))
 
-  def log_updated(self, session, model):
-    if not (isinstance(model, Entity)
-            and hasattr(model, '__changes__')):
+  def log_new(self, rows, model, user_id):
+    if not isinstance(model, Entity):
       return
 
-    entry = AuditEntry.from_model(model, type=UPDATE)
-    entry.changes = model.__changes__
-    session.add(entry)
+    rows.append(entry_values(model, CREATION, user_id))
 
-    del model.__changes__
+  def log_updated(self, rows, model, user_id):
+    if not isinstance(model, Entity):
+      return
+    changes = self.changes_for(model)
+    if not changes:
+      return
 
-  def log_deleted(self, session, model):
+    values = entry_values(model, UPDATE, user_id)
+    values['changes_json'] = dump_changes(changes)
+    rows.append(values)
+
+  def log_deleted(self, rows, model, user_id):
     if not isinstance(model, Entity):
       return
 
-    entry = AuditEntry.from_model(model, type=DELETION)
-    session.add(entry)
+    rows.append(entry_values(model, DELETION, user_id))
+
+  def entries_for(self, entity, before=None, limit=PAGE_SIZE):
+    """Audit entries of `entity`, most recent first, with their `user`.
+
+    Returns at most `limit` entries (all of them if `limit` is `None`),
+    older than the entry whose id is `before` if given: pass the id of the
+    last entry of a page to get the next one.
+
+    Archived entries (see :meth:`archive_entries`) are returned after the
+    ones still in the database.
+    """
+    query = AuditEntry.query\
+      .filter(AuditEntry.entity_class == entity.__class__.__name__)\
+      .filter(AuditEntry.entity_id == entity.id)
+    entries = self._page(query, before, limit)
+    for entry in entries:
+      entry._entity = entity
+
+    if self.archive is not None and (limit is None or len(entries) < limit):
+      if limit is not None:
+        limit -= len(entries)
+      entries += self.archived_entries_for(entity, before, limit)
+    return entries
+
+  def recent_entries(self, before=None, limit=PAGE_SIZE):
+    """Audit entries of all entities, most recent first, with their `user`
+    and `entity` loaded. Pagination works as in :meth:`entries_for`."""
+    return load_entities(self._page(AuditEntry.query, before, limit))
+
+  def _page(self, query, before, limit):
+    query = query.options(joinedload(AuditEntry.user))
+    if before is not None:
+      # Entries of a same flush share their happened_at: id breaks ties.
+      before_at = select([AuditEntry.happened_at])\
+        .where(AuditEntry.id == before).as_scalar()
+      query = query.filter(or_(
+        AuditEntry.happened_at < before_at,
+        and_(AuditEntry.happened_at == before_at, AuditEntry.id < before)))
+
+    query = query.order_by(AuditEntry.happened_at.desc(),
+                           AuditEntry.id.desc())
+    if limit is not None:
+      query = query.limit(limit)
+    return query.all()
+
+  def archived_entries_for(self, entity, before=None, limit=None):
+    """Archived audit entries of `entity` (transient objects), like
+    :meth:`entries_for`."""
+    rows = self.archive.rows_for(entity.__class__.__name__, entity.id)
+    rows.sort(key=lambda row: (row['happened_at'], row['id']), reverse=True)
+
+    if before is not None:
+      before_at = db.session.query(AuditEntry.happened_at)\
+        .filter(AuditEntry.id == before).scalar()
+      if before_at is None:
+        before_at = ([row['happened_at'] for row in rows
+                      if row['id'] == before] or [None])[0]
+      if before_at is not None:
+        rows = [row for row in rows
+                if (row['happened_at'], row['id']) < (before_at, before)]
+    if limit is not None:
+      rows = rows[:limit]
+
+    user_ids = set(row['user_id'] for row in rows if row['user_id'])
+    users = {}
+    if user_ids:
+      users = dict((user.id, user) for user in
+                   User.query.filter(User.id.in_(user_ids)).all())
+
+    entries = []
+    for row in rows:
+      entry = AuditEntry(**row)
+      entry.user = users.get(row['user_id'])
+      entry._entity = entity
+      entries.append(entry)
+    return entries
+
+  def archive_entries(self, months=None, batch_size=1000):
+    """Moves the entries older than `months` months (defaults to the
+    `AUDIT_RETENTION_MONTHS` setting) to the archive. Returns the number of
+    archived entries."""
+    months = months or self.retention_months
+    if not months or self.archive is None:
+      raise ValueError("Audit retention isn't configured "
+                       "(AUDIT_RETENTION_MONTHS, AUDIT_ARCHIVE_DIR)")
+    cutoff = month_start(datetime.utcnow(), months)
+    return self.archive.archive(cutoff, batch_size)
+
+
+def month_start(dt, months_ago=0):
+  """First day of the month `months_ago` months before the one of `dt`."""
+  index = dt.year * 12 + dt.month - 1 - months_ago
+  return datetime(index // 12, index % 12 + 1, 1)
+
+
+class AuditArchive(object):
+  """
+  Archived audit entries: one gzipped JSON-lines file per month under
+  `directory`, one line per entry (see :func:`dump_rows`).
+
+  Archiving appends to the files then deletes the archived rows, in batches,
+  so it can be interrupted. An entry can then be archived twice: readers
+  ignore duplicates.
+
+  Each batch is a separate gzip member. A sidecar index per month (lines of
+  a hash of the entity class and id, and the offset of a member with entries
+  of this entity) lets :meth:`rows_for` only decompress the members it
+  needs. Index lines are appended once each member is written: a member left
+  unindexed by an interrupted run only holds entries which are archived
+  again (and indexed) by the next run.
+  """
+
+  #: Length of the index lines: 16 hex digits, space, 12 digits, newline.
+  INDEX_LINE = 30
+
+  def __init__(self, directory):
+    self.directory = directory
+
+  def path(self, month):
+    return os.path.join(self.directory,
+                        "audit-%04d-%02d.jsonl.gz" % (month.year, month.month))
+
+  @staticmethod
+  def index_path(path):
+    return path[:-len(".jsonl.gz")] + ".idx"
+
+  @staticmethod
+  def index_key(entity_class, entity_id):
+    return hashlib.md5("%s:%d" % (entity_class, entity_id)).hexdigest()[:16]
+
+  def paths(self, reverse=False):
+    """Paths of the archive files, by month."""
+    if not os.path.isdir(self.directory):
+      return []
+    return [os.path.join(self.directory, fn)
+            for fn in sorted(os.listdir(self.directory), reverse=reverse)
+            if fn.endswith(".jsonl.gz")]
+
+  def is_indexed(self, path):
+    return os.path.exists(self.index_path(path))
+
+  def index(self, path):
+    """(Re)builds the index of an archive file, ex: one archived before
+    indexes existed."""
+    lines = set()
+    for offset, data in iter_members(path):
+      # Same line may appear in several batches: one index line per member.
+      for line in data.splitlines():
+        row = json.loads(line)
+        key = self.index_key(row['entity_class'], row['entity_id'])
+        lines.add("%s %012d\n" % (key, offset))
+
+    index_path = self.index_path(path)
+    with open(index_path + ".tmp", "wb") as fd:
+      fd.writelines(sorted(lines))
+    os.rename(index_path + ".tmp", index_path)
+
+  def append_index(self, path, offset, rows):
+    """Indexes `rows`, written in the member of `path` at `offset`."""
+    keys = set(self.index_key(row['entity_class'], row['entity_id'])
+               for row in rows)
+    index_path = self.index_path(path)
+    size = os.path.getsize(index_path) if os.path.exists(index_path) else 0
+    with open(index_path, "ab") as fd:
+      if size % self.INDEX_LINE:
+        # Line left incomplete by an interrupted run.
+        fd.truncate(size - size % self.INDEX_LINE)
+      fd.writelines("%s %012d\n" % (key, offset) for key in sorted(keys))
+
+  def lookup(self, path, key):
+    """Offsets of the members of `path` which may have entries for `key`
+    (see :meth:`index_key`), from its index."""
+    with open(self.index_path(path), "rb") as fd:
+      data = fd.read()
+    # Only the key of a line can be followed by a space.
+    key += " "
+    offsets = []
+    start = data.find(key)
+    while start != -1:
+      line = data[start:start + self.INDEX_LINE]
+      if len(line) == self.INDEX_LINE:
+        offsets.append(int(line[17:29]))
+      start = data.find(key, start + self.INDEX_LINE)
+    return offsets
+
+  def archive(self, cutoff, batch_size=1000, session=None):
+    """Archives the entries that happened before `cutoff`, `batch_size`
+    entries per transaction."""
+    session = session or db.session
+    table = AuditEntry.__table__
+    if not os.path.isdir(self.directory):
+      os.makedirs(self.directory)
+
+    count = 0
+    while True:
+      rows = session.execute(
+        table.select()
+        .where(table.c.happened_at < cutoff)
+        .order_by(table.c.happened_at, table.c.id)
+        .limit(batch_size)).fetchall()
+      if not rows:
+        break
+
+      by_month = {}
+      for row in rows:
+        row = dict(row.items())
+        if row['changes_pickle']:
+          row['changes_json'] = dump_changes(
+            pickle.loads(str(row['changes_pickle'])))
+        del row['changes_pickle']
+        by_month.setdefault(month_start(row['happened_at']), []).append(row)
+
+      for month, month_rows in sorted(by_month.items()):
+        path = self.path(month)
+        offset = 0
+        if os.path.exists(path):
+          offset = os.path.getsize(path)
+          if not self.is_indexed(path):
+            self.index(path)
+        with gzip.open(path, "ab") as fd:
+          for row in month_rows:
+            fd.write(dump_rows(row) + "\n")
+        self.append_index(path, offset, month_rows)
+
+      session.execute(table.delete()
+                      .where(table.c.id.in_([row.id for row in rows])))
+      session.commit()
+      count += len(rows)
+      logger.info("Archived %d audit entries", count)
+
+    return count
+
+  def iter_rows(self, start=None, end=None):
+    """Yields the archived rows of the months between `start` and `end`
+    (both optional), in chronological order.
+
+    Archiving appends entries in order, so rows are streamed: a row not
+    after the previous one is a duplicate from an interrupted run, and is
+    skipped.
+    """
+    first = month_start(start) if start is not None else None
+    last_key = None
+    for path in self.paths():
+      name = os.path.basename(path)
+      month = datetime(int(name[6:10]), int(name[11:13]), 1)
+      if ((first is not None and month < first)
+          or (end is not None and month >= end)):
+        continue
+      for _, data in iter_members(path):
+        for line in data.splitlines():
+          row = load_rows(line)
+          key = row['happened_at'], row['id']
+          if last_key is not None and key <= last_key:
+            continue
+          last_key = key
+          yield row
+
+  def rows_for(self, entity_class, entity_id):
+    """Archived rows of an entity. Only decompresses the members listed in
+    the indexes (files without an index are read entirely)."""
+    key = self.index_key(entity_class, entity_id)
+    # Cheap test before decoding lines.
+    marker = '"entity_id":%d' % entity_id
+    rows = {}
+    for path in self.paths(reverse=True):
+      if self.is_indexed(path):
+        members = [read_member(path, offset)
+                   for offset in self.lookup(path, key)]
+      else:
+        members = (data for _, data in iter_members(path))
+      for data in members:
+        for line in data.splitlines():
+          if marker not in line:
+            continue
+          row = load_rows(line)
+          if (row['entity_class'] == entity_class
+              and row['entity_id'] == entity_id):
+            rows[row['id']] = row
+    return rows.values()
+
+
+def iter_members(path, chunk_size=1 << 16):
+  """Yields `(offset, data)` for each member of the gzip file `path`."""
+  with open(path, "rb") as fd:
+    offset = 0
+    pending = ""
+    while True:
+      buf = pending or fd.read(chunk_size)
+      if not buf:
+        return
+      decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+      data = []
+      consumed = 0
+      while True:
+        data.append(decompressor.decompress(buf))
+        pending = decompressor.unused_data
+        consumed += len(buf) - len(pending)
+        if pending:
+          break
+        buf = fd.read(chunk_size)
+        if not buf:
+          break
+      data.append(decompressor.flush())
+      yield offset, "".join(data)
+      offset += consumed
+
+
+def read_member(path, offset, chunk_size=1 << 16):
+  """Data of the member of the gzip file `path` which starts at `offset`."""
+  with open(path, "rb") as fd:
+    fd.seek(offset)
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    data = []
+    while not decompressor.unused_data:
+      buf = fd.read(chunk_size)
+      if not buf:
+        break
+      data.append(decompressor.decompress(buf))
+    data.append(decompressor.flush())
+    return "".join(data)
+
+
+def dump_rows(rows):
+  """Serializes audit rows (column values), for spool files and tasks."""
+  return json.dumps(rows, default=_encode_value, separators=(',', ':'))
+
+
+def load_rows(data):
+  return json.loads(data, object_hook=_decode_value)
+
+
+def insert_rows(bind, rows):
+  bind.execute(AuditEntry.__table__.insert(), rows)
+
+
+def spool_rows(path, rows):
+  """Appends `rows` to the spool file `path`."""
+  with open(path, "a") as fd:
+    fd.write(dump_rows(rows) + "\n")
+
+
+class AuditWriter(object):
+  """
+  Writes audit rows from a background thread, in batches of up to
+  `batch_size` rows.
+
+  Rows waiting to be written are also appended to `spool_file` (if given),
+  which is emptied when everything has been written, and replayed when the
+  writer starts: rows are written at least once, even if the process dies.
+  Rows that can't be written are kept in `spool_file + ".failed"`, also
+  replayed on start.
+  """
+
+  def __init__(self, app, spool_file=None, batch_size=500):
+    self.app = app
+    self.spool_file = spool_file
+    self.batch_size = batch_size
+    self.queue = Queue()
+    self._lock = threading.Lock()
+    self._thread = None
+
+  def start(self):
+    self.replay()
+    self._thread = threading.Thread(target=self._run, name="audit-writer")
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    """Writes pending rows and stops the thread."""
+    self.queue.put(None)
+    self._thread.join()
+    self._thread = None
+
+  def put(self, rows):
+    with self._lock:
+      if self.spool_file:
+        spool_rows(self.spool_file, rows)
+      self.queue.put(rows)
+
+  def flush(self):
+    """Waits until all the rows have been written."""
+    self.queue.join()
+
+  def replay(self):
+    if not self.spool_file:
+      return
+    for path in (self.spool_file + ".failed", self.spool_file):
+      if not os.path.exists(path):
+        continue
+      with open(path) as fd:
+        rows = [row for line in fd if line.strip()
+                for row in load_rows(line)]
+      if rows:
+        logger.info("Writing %d audit entries from %s", len(rows), path)
+        self.write(rows)
+      os.remove(path)
+
+  def write(self, rows):
+    engine = db.get_engine(self.app)
+    try:
+      for i in range(0, len(rows), self.batch_size):
+        insert_rows(engine, rows[i:i + self.batch_size])
+    except Exception:
+      logger.exception("Can't write %d audit entries", len(rows))
+      if self.spool_file:
+        spool_rows(self.spool_file + ".failed", rows)
+
+  def _run(self):
+    stopping = False
+    while not stopping:
+      batch = self.queue.get()
+      items = 1
+      if batch is None:
+        stopping = True
+        batch = []
+      # Group what's already queued.
+      while not stopping and len(batch) < self.batch_size:
+        try:
+          rows = self.queue.get_nowait()
+        except Empty:
+          break
+        items += 1
+        if rows is None:
+          stopping = True
+        else:
+          batch = batch + rows
+
+      if batch:
+        self.write(batch)
+      if self.spool_file:
+        with self._lock:
+          if self.queue.empty() and os.path.exists(self.spool_file):
+            os.remove(self.spool_file)
+      for i in range(items):
+        self.queue.task_done()
+
+
+@celery.task(ignore_result=True)
+def write_audit_entries(data):
+  """Writes audit rows serialized by :func:`dump_rows`."""
+  insert_rows(db.session.get_bind(None, None), load_rows(data))
 
-  def entries_for(self, entity):
-    return AuditEntry.query.filter(
-      AuditEntry.entity_class == entity.__class__.__name__,
-      AuditEntry.entity_id == entity.id).all()
 
 audit_service = AuditService()
 
@@ -1,35 +1,52 @@
 """
 Conversion service.
 
-Hardcoded to manage only conversion to PDF, to text and to image series.
+Manages conversion to PDF, to text and to image series. Conversions that no
+single handler can perform are planned as a chain of handlers (for instance,
+MS-Word -> PDF -> text).
 
 Includes result caching (on filesystem).
 
 Assumes poppler-utils and LibreOffice are installed.
 """
 
-import glob
+import functools
 import hashlib
+import json
 import shutil
-import itertools
 import logging
 from tempfile import mktemp, mkstemp
 import traceback
 from abc import ABCMeta, abstractmethod
 from magic import Magic
 import os
+import signal
 import subprocess
 import threading
+import time
+from collections import defaultdict
 from base64 import encodestring, decodestring
 from xmlrpclib import ServerProxy
 import mimetypes
 import re
 import StringIO
+import zlib
 
 from PIL import Image
 from PIL.ExifTags import TAGS
 
-from yaka.services.image import resize
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+from yaka.core.signals import conversion_metric
+from yaka.core.util import stream_digest
 
 logger = logging.getLogger(__name__)
 
@@ -40,26 +57,221 @@ os.environ['PATH'] += ":/usr/local/bin"
 TMP_DIR = "tmp"
 CACHE_DIR = "cache"
 
-mime_sniffer = Magic(mime=True)
-encoding_sniffer = Magic(mime_encoding=True)
+
+class Sniffer(threading.local):
+  """A :class:`Magic` with one libmagic handle per thread, as handles can't
+  be shared between threads (ex: batch conversions)."""
+
+  def __init__(self, **kw):
+    self._magic = Magic(**kw)
+
+  def from_file(self, filename):
+    return self._magic.from_file(filename)
+
+  def from_buffer(self, buffer):
+    return self._magic.from_buffer(buffer)
+
+
+mime_sniffer = Sniffer(mime=True)
+encoding_sniffer = Sniffer(mime_encoding=True)
+
+#: Intermediate formats whose conversion results are worth caching when they
+#: show up in the middle of a conversion chain (mime type => cache key prefix).
+INTERMEDIATE_CACHE_PREFIXES = {
+  "application/pdf": "pdf:",
+}
+
+
+#: Codecs for compressed cache entries: id => (compress, decompress). The id
+#: is stored in the entry header.
+CODECS = {
+  "z": (lambda data: zlib.compress(data, 6), zlib.decompress),
+}
+if zstandard is not None:
+  CODECS["s"] = (lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+                 lambda data: zstandard.ZstdDecompressor().decompress(data))
+
+#: Header of compressed cache entries, followed by the codec id. Can't be
+#: mistaken for the start of a legacy (uncompressed) entry: 0x89 never starts
+#: an UTF-8 text, a PDF or a JPEG file.
+COMPRESSED_MAGIC = "\x89YKC"
 
 
 class ConversionError(Exception):
   pass
 
 
+class ProcessKilled(ConversionError):
+  """A conversion tool was killed: timeout or resource limit reached."""
+
+
+class ConversionTimeout(ProcessKilled):
+  pass
+
+
+class ConversionStats(object):
+  """
+  Counters and latency histograms of the conversion service.
+
+  Each metric has a name and tags (ex: `handler`, `target`). Every recorded
+  value is also sent through the :data:`yaka.core.signals.conversion_metric`
+  signal.
+  """
+
+  #: Upper bounds (in seconds) of the latency histogram buckets.
+  latency_buckets = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, float('inf'))
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self._lock:
+      self.counters = defaultdict(int)
+      self.timings = {}
+
+  @staticmethod
+  def _key(name, tags):
+    return (name, tuple(sorted(tags.items())))
+
+  def incr(self, name, value=1, **tags):
+    with self._lock:
+      self.counters[self._key(name, tags)] += value
+    conversion_metric.send(self, kind="counter", name=name, value=value,
+                           tags=tags)
+
+  def timing(self, name, seconds, **tags):
+    key = self._key(name, tags)
+    with self._lock:
+      timing = self.timings.get(key)
+      if timing is None:
+        timing = self.timings[key] = dict(
+          count=0, sum=0.0, buckets=[0] * len(self.latency_buckets))
+      timing['count'] += 1
+      timing['sum'] += seconds
+      for i, bound in enumerate(self.latency_buckets):
+        if seconds <= bound:
+          timing['buckets'][i] += 1
+          break
+    conversion_metric.send(self, kind="timing", name=name, value=seconds,
+                           tags=tags)
+
+  def get(self, name, **tags):
+    return self.counters.get(self._key(name, tags), 0)
+
+  def cache_hit_ratio(self, target):
+    hits = self.get("cache.hit", target=target)
+    total = hits + self.get("cache.miss", target=target)
+    return 1.0 * hits / total if total else None
+
+  def to_dict(self):
+    """JSON-friendly snapshot of all metrics."""
+    with self._lock:
+      counters = [dict(name=name, tags=dict(tags), value=value)
+                  for (name, tags), value in sorted(self.counters.items())]
+      timings = []
+      for (name, tags), timing in sorted(self.timings.items()):
+        # Cumulative counts, as usual for histograms.
+        buckets = []
+        count = 0
+        for bound, n in zip(self.latency_buckets, timing['buckets']):
+          count += n
+          buckets.append(["+Inf" if bound == float('inf') else bound, count])
+        timings.append(dict(name=name, tags=dict(tags), count=timing['count'],
+                            sum=timing['sum'], buckets=buckets))
+
+    targets = set(c['tags'].get('target') for c in counters
+                  if c['name'] in ("cache.hit", "cache.miss"))
+    hit_ratios = dict((target, self.cache_hit_ratio(target))
+                      for target in targets)
+    return dict(counters=counters, timings=timings, cache_hit_ratio=hit_ratios)
+
+
 class Cache(object):
+  """
+  Keys are made of a prefix and of the content digest, separated by a colon
+  (ex: "pdf:<digest>", "img:<index>:<size>:<digest>", "pages:<digest>").
+
+  A digest can be aliased to a legacy (MD5) digest, so that entries computed
+  before the switch to streaming digests are still found.
+
+  Entries written with :meth:`set` are compressed according to their key
+  prefix (see :attr:`codecs`) and transparently decompressed by :meth:`get`.
+  Uncompressed entries (including legacy ones) are read as is.
+
+  Entries are files in `cache_dir` (default: :data:`CACHE_DIR`).
+  """
+
+  #: Compression codec id (see :data:`CODECS`) by key prefix. Entries whose
+  #: files are handed to conversion tools (ex: PDFs, see :meth:`get_path`)
+  #: must not be compressed.
+  codecs = {
+    "txt:": "s" if "s" in CODECS else "z",
+    "meta:": "s" if "s" in CODECS else "z",
+  }
+
+  def __init__(self, cache_dir=None):
+    self.cache_dir = cache_dir or CACHE_DIR
 
   def _path(self, key):
     """ file path for `key`"""
-    return os.path.join("cache", "{}.blob".format(key))
+    return os.path.join(self.cache_dir, "{}.blob".format(key))
+
+  def _alias_path(self, digest):
+    return os.path.join(self.cache_dir, "{}.alias".format(digest))
+
+  def get_path(self, key):
+    """ file path of the entry for `key`, following digest aliases, or None
+    if there is no such entry."""
+    path = self._path(key)
+    if os.path.exists(path):
+      return path
+
+    prefix, sep, digest = key.rpartition(":")
+    alias_path = self._alias_path(digest)
+    if not os.path.exists(alias_path):
+      return None
+    legacy_digest = open(alias_path, "rb").read().strip()
+    path = self._path(prefix + sep + legacy_digest)
+    return path if os.path.exists(path) else None
+
+  def new_path(self, key):
+    """ file path where to write the entry for `key`."""
+    self._ensure_dir()
+    return self._path(key)
 
   def __contains__(self, key):
-    return os.path.exists(self._path(key))
+    return self.get_path(key) is not None
+
+  def set_alias(self, digest, legacy_digest):
+    """ Make entries stored under `legacy_digest` reachable from `digest`."""
+    if digest == legacy_digest:
+      return
+    self._ensure_dir()
+    with open(self._alias_path(digest), "wb") as fd:
+      fd.write(legacy_digest)
+
+  def _ensure_dir(self):
+    if not os.path.exists(self.cache_dir):
+      os.makedirs(self.cache_dir)
+
+  def _codec_for(self, key):
+    for prefix, codec in self.codecs.items():
+      if key.startswith(prefix):
+        return codec
+    return None
 
   def get(self, key):
-    if key in self:
-      value = open(self._path(key), 'rb').read()
+    path = self.get_path(key)
+    if path is not None:
+      value = open(path, 'rb').read()
+      if value.startswith(COMPRESSED_MAGIC):
+        codec = value[len(COMPRESSED_MAGIC)]
+        if codec not in CODECS:
+          # Ex: written with zstd, which isn't installed here.
+          logger.warning("Unknown codec %r for cache entry %s", codec, key)
+          return None
+        value = CODECS[codec][1](value[len(COMPRESSED_MAGIC) + 1:])
       if key.startswith("txt:"):
         value = unicode(value, encoding="utf8")
       return value
@@ -69,13 +281,19 @@ class Cache(object):
   __getitem__ = get
 
   def set(self, key, value):
-    if not os.path.exists(CACHE_DIR):
-      os.mkdir(CACHE_DIR)
-    fd = open(self._path(key), "wbc")
+    self._ensure_dir()
     if key.startswith("txt:"):
-      fd.write(value.encode("utf8"))
-    else:
-      fd.write(value)
+      value = value.encode("utf8")
+
+    codec = self._codec_for(key)
+    if codec:
+      compressed = CODECS[codec][0](value)
+      # Tiny values may not compress at all.
+      if len(compressed) + len(COMPRESSED_MAGIC) + 1 < len(value):
+        value = COMPRESSED_MAGIC + codec + compressed
+
+    fd = open(self._path(key), "wbc")
+    fd.write(value)
     fd.close()
 
   __setitem__ = set
@@ -85,40 +303,215 @@ class Cache(object):
 
 
 class Converter(object):
+
+  #: Maximum number of handlers chained to perform a single conversion.
+  max_chain_length = 3
+
   def __init__(self):
     self.handlers = []
     self.cache = Cache()
+    self.stats = ConversionStats()
+    self._chains = {}
     if not os.path.exists(TMP_DIR):
       os.mkdir(TMP_DIR)
     if not os.path.exists(CACHE_DIR):
       os.mkdir(CACHE_DIR)
 
   def init_app(self, app):
-
+    # Temporary files can be put on a tmpfs (ex: /dev/shm/yaka) to save disk
+    # I/O.
+    global TMP_DIR
+    tmp_dir = app.config.get('CONVERSION_TMP_DIR')
+    if tmp_dir:
+      TMP_DIR = tmp_dir
+      if not os.path.exists(TMP_DIR):
+        os.makedirs(TMP_DIR)
+
+    # Per-handler overrides of the subprocess limits, ex:
+    # {'ImageMagickHandler': {'run_timeout': 30, 'memory_limit': 2 << 30}}
+    limits = app.config.get('CONVERSION_HANDLER_LIMITS', {})
     for handler in self.handlers:
+      for attr, value in limits.get(handler.__class__.__name__, {}).items():
+        if attr not in ('run_timeout', 'memory_limit', 'cpu_limit'):
+          raise ValueError("Unknown handler limit: {}".format(attr))
+        setattr(handler, attr, value)
       handler.init_app(app)
 
   def clear(self):
     self.cache.clear()
     shutil.rmtree(TMP_DIR)
-    shutil.rmtree(CACHE_DIR)
+    shutil.rmtree(self.cache.cache_dir)
 
   def register_handler(self, handler):
     self.handlers.append(handler)
+    self._chains = {}
+
+  def find_chain(self, source_mime_type, target_mime_type):
+    """Returns the shortest list of `(handler, produced mime type)` steps
+    that converts from `source_mime_type` to `target_mime_type`, or `None` if
+    there isn't any.
+
+    Results are memoized until a new handler is registered. When several
+    chains of the same length exist, handlers registered first win. Handlers
+    with :attr:`Handler.multiple_outputs` are only used as the last step.
+    """
+    key = (source_mime_type, target_mime_type)
+    try:
+      return self._chains[key]
+    except KeyError:
+      pass
+
+    chain = self._plan_chain(source_mime_type, target_mime_type)
+    self._chains[key] = chain
+    return chain
+
+  def _plan_chain(self, source_mime_type, target_mime_type):
+    # Breadth-first search over mime types. Produced mime types are expected to
+    # be plain mime types, not patterns.
+    if source_mime_type == target_mime_type:
+      return None
+    paths = [(source_mime_type, [])]
+    seen = set([source_mime_type])
+
+    for _ in range(self.max_chain_length):
+      next_paths = []
+      for mime_type, path in paths:
+        for handler in self.handlers:
+          if not handler.accepts(mime_type):
+            continue
+          if handler.produces(target_mime_type):
+            return path + [(handler, target_mime_type)]
+          if handler.multiple_outputs:
+            continue
+          for produced in handler.produces_mime_types:
+            if produced in seen:
+              continue
+            seen.add(produced)
+            next_paths.append((produced, path + [(handler, produced)]))
+      paths = next_paths
+
+    return None
+
+  def _run_chain(self, digest, in_fn, mime_type, target_mime_type):
+    """Runs all the steps but the last one of the conversion chain from
+    `mime_type` to `target_mime_type`.
+
+    Intermediate results listed in :data:`INTERMEDIATE_CACHE_PREFIXES` are
+    read from / written to the cache, others go to temporary files.
+
+    Returns `(handler, in_fn, temp_files)`: the last handler to run, the path
+    it should read from, and temporary files to remove once done.
+    """
+    chain = self.find_chain(mime_type, target_mime_type)
+    if chain is None:
+      raise ConversionError("No handler found to convert from %s to %s"
+                            % (mime_type, target_mime_type))
+
+    temp_files = []
+    try:
+      for handler, produced in chain[:-1]:
+        prefix = INTERMEDIATE_CACHE_PREFIXES.get(produced)
+        if prefix:
+          cache_key = prefix + digest
+          out_fn = self.cache.get_path(cache_key)
+          if out_fn is None:
+            out_fn = self._convert_to_cache(handler, produced, in_fn,
+                                            cache_key)
+        else:
+          out_fn = make_temp_file("")
+          temp_files.append(out_fn)
+          self._call_handler(handler, produced, handler.convert_to_file,
+                             in_fn, out_fn)
+        in_fn = out_fn
+    except:
+      remove_files(temp_files)
+      raise
+
+    return chain[-1][0], in_fn, temp_files
+
+  def _call_handler(self, handler, target_mime_type, method, in_fn, *args,
+                    **kw):
+    """Calls `method` of `handler` on `in_fn`, recording metrics: latency,
+    successes, failures, timeouts, killed tools, and bytes in / out."""
+    tags = dict(handler=handler.__class__.__name__, target=target_mime_type)
+    start = time.time()
+    try:
+      result = method(in_fn, *args, **kw)
+    except ProcessKilled, e:
+      self.stats.incr("handler.killed", **tags)
+      if isinstance(e, ConversionTimeout):
+        self.stats.incr("handler.timeout", **tags)
+      else:
+        self.stats.incr("handler.failure", **tags)
+      raise
+    except Exception:
+      self.stats.incr("handler.failure", **tags)
+      raise
+    finally:
+      self.stats.timing("handler.latency", time.time() - start, **tags)
+
+    self.stats.incr("handler.success", **tags)
+    self.stats.incr("handler.bytes_in", os.path.getsize(in_fn), **tags)
+    if args:
+      # convert_to_file(in_fn, out_fn)
+      bytes_out = os.path.getsize(args[0])
+    elif isinstance(result, list):
+      bytes_out = sum(len(item) for item in result)
+    else:
+      bytes_out = len(result)
+    self.stats.incr("handler.bytes_out", bytes_out, **tags)
+    return result
+
+  def _convert_to_cache(self, handler, target_mime_type, in_fn, cache_key,
+                        **kw):
+    """Runs `handler` on `in_fn`, writing its output straight to the cache
+    entry for `cache_key`. Returns the entry path."""
+    path = self.cache.new_path(cache_key)
+    fd, out_fn = mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    os.close(fd)
+    try:
+      self._call_handler(handler, target_mime_type, handler.convert_to_file,
+                         in_fn, out_fn, **kw)
+      os.rename(out_fn, path)
+    except:
+      remove_files([out_fn])
+      raise
+    return path
 
   # TODO: refactor, pass a "File" or "Document" or "Blob" object
   def to_pdf(self, digest, blob, mime_type):
     cache_key = "pdf:" + digest
     pdf = self.cache.get(cache_key)
     if pdf:
+      self.stats.incr("cache.hit", target="pdf")
       return pdf
 
-    for handler in self.handlers:
-      if handler.accept(mime_type, "application/pdf"):
-        pdf = handler.convert(blob)
-        self.cache[cache_key] = pdf
-        return pdf
-    raise ConversionError("No handler found to convert from %s to PDF" % mime_type)
+    in_fn = make_temp_file(blob)
+    try:
+      return open(self.to_pdf_file(digest, in_fn, mime_type), 'rb').read()
+    finally:
+      os.remove(in_fn)
+
+  def to_pdf_file(self, digest, in_fn, mime_type):
+    """Path-based version of :meth:`to_pdf`.
+
+    Converts the file at `in_fn`, and returns the path of the PDF in the cache
+    (which must not be modified).
+    """
+    cache_key = "pdf:" + digest
+    path = self.cache.get_path(cache_key)
+    if path:
+      self.stats.incr("cache.hit", target="pdf")
+      return path
+    self.stats.incr("cache.miss", target="pdf")
+
+    handler, in_fn, temp_files = self._run_chain(digest, in_fn, mime_type,
+                                                 "application/pdf")
+    try:
+      return self._convert_to_cache(handler, "application/pdf", in_fn,
+                                    cache_key)
+    finally:
+      remove_files(temp_files)
 
   def to_text(self, digest, blob, mime_type):
     """Converts a file to plain text.
@@ -133,24 +526,38 @@ class Converter(object):
 
     text = self.cache.get(cache_key)
     if text:
+      self.stats.incr("cache.hit", target="text")
       return text
 
-    # Direct conversion possible
-    for handler in self.handlers:
-      if handler.accept(mime_type, "text/plain"):
-        text = handler.convert(blob)
-        self.cache[cache_key] = text
-        return text
+    in_fn = make_temp_file(blob)
+    try:
+      return self.to_text_file(digest, in_fn, mime_type)
+    finally:
+      os.remove(in_fn)
 
-    # Use PDF as a pivot format
-    pdf = self.to_pdf(digest, blob, mime_type)
-    for handler in self.handlers:
-      if handler.accept("application/pdf", "text/plain"):
-        text = handler.convert(pdf)
-        self.cache[cache_key] = text
-        return text
+  def to_text_file(self, digest, in_fn, mime_type):
+    """Path-based version of :meth:`to_text`."""
+    # Special case, for now (XXX).
+    if mime_type.startswith("image/"):
+      return u""
+
+    cache_key = "txt:" + digest
 
-    raise ConversionError()
+    text = self.cache.get(cache_key)
+    if text:
+      self.stats.incr("cache.hit", target="text")
+      return text
+    self.stats.incr("cache.miss", target="text")
+
+    handler, in_fn, temp_files = self._run_chain(digest, in_fn, mime_type,
+                                                 "text/plain")
+    try:
+      text = self._call_handler(handler, "text/plain", handler.convert_file,
+                                in_fn)
+    finally:
+      remove_files(temp_files)
+    self.cache[cache_key] = text
+    return text
 
   def has_image(self, digest, mime_type, index, size=500):
     """ Tell if there is a preview image
@@ -180,64 +587,137 @@ class Converter(object):
     cache_key = "img:%s:%s:%s" % (index, size, digest)
     converted = self.cache.get(cache_key)
     if converted:
+      self.stats.incr("cache.hit", target="image")
       return converted
 
-    # Direct conversion possible
-    for handler in self.handlers:
-      if handler.accept(mime_type, "image/jpeg"):
-        converted_images = handler.convert(blob, size=size)
-        for i in range(0, len(converted_images)):
-          converted = converted_images[i]
-          self.cache["img:%s:%s:%s" % (i, size, digest)] = converted
-        return converted_images[index]
-
-    # Use PDF as a pivot format
-    pdf = self.to_pdf(digest, blob, mime_type)
-    for handler in self.handlers:
-      if handler.accept("application/pdf", "image/jpeg"):
-        converted_images = handler.convert(pdf, size=size)
-        for i in range(0, len(converted_images)):
-          converted = converted_images[i]
-          self.cache["img:%s:%s:%s" % (i, size, digest)] = converted
-        return converted_images[index]
+    in_fn = make_temp_file(blob)
+    try:
+      return self.to_image_file(digest, in_fn, mime_type, index, size=size)
+    finally:
+      os.remove(in_fn)
 
-    raise ConversionError()
+  def to_image_file(self, digest, in_fn, mime_type, index, size=500,
+                    max_pages=None):
+    """Path-based version of :meth:`to_image`.
+
+    If `max_pages` is given, only the first `max_pages` pages are rendered
+    (and cached), when the handler supports it.
+    """
+    # Special case, for now (XXX).
+    if mime_type.startswith("image/"):
+      return ""
+
+    cache_key = "img:%s:%s:%s" % (index, size, digest)
+    converted = self.cache.get(cache_key)
+    if converted:
+      self.stats.incr("cache.hit", target="image")
+      return converted
+    self.stats.incr("cache.miss", target="image")
+
+    return self.to_images_file(digest, in_fn, mime_type, size=size,
+                               max_pages=max_pages)[index]
+
+  def to_images_file(self, digest, in_fn, mime_type, size=500,
+                     max_pages=None):
+    """Renders the pages of a document (the first `max_pages` ones, if
+    given) and caches them. Returns the list of images.
+
+    When all the pages have been rendered, their number is cached as well
+    (see :meth:`page_count`).
+    """
+    handler, in_fn, temp_files = self._run_chain(digest, in_fn, mime_type,
+                                                 "image/jpeg")
+    try:
+      kw = dict(size=size)
+      if max_pages:
+        kw['max_pages'] = max_pages
+      converted_images = self._call_handler(handler, "image/jpeg",
+                                            handler.convert_file, in_fn, **kw)
+    finally:
+      remove_files(temp_files)
+
+    for i in range(0, len(converted_images)):
+      converted = converted_images[i]
+      self.cache["img:%s:%s:%s" % (i, size, digest)] = converted
+    if not max_pages or len(converted_images) < max_pages:
+      self.cache["pages:" + digest] = str(len(converted_images))
+    return converted_images
+
+  def page_count(self, digest):
+    """Number of pages of a document, if known from a previous rendering
+    (see :meth:`to_images_file`)."""
+    count = self.cache.get("pages:" + digest)
+    return int(count) if count else None
 
   def get_metadata(self, digest, content, mime_type):
-    """Gets a dictionary representing the metadata embedded in the given content."""
+    """Gets a dictionary representing the metadata embedded in the given content.
+
+    Results are cached (see :func:`normalize_metadata` for the value types).
+    """
+    metadata = self._get_cached_metadata(digest)
+    if metadata is not None:
+      return metadata
 
     # XXX: ad-hoc for now, refactor later
     if mime_type.startswith("image/"):
-      img = Image.open(StringIO.StringIO(content))
-      ret = {}
-      if not hasattr(img, '_getexif'):
-        return {}
-      info = img._getexif()
-      if not info:
-        return {}
-      for tag, value in info.items():
-        decoded = TAGS.get(tag, tag)
-        ret["EXIF:" + str(decoded)] = value
-      return ret
+      metadata = image_metadata(StringIO.StringIO(content))
     else:
+      pdf_fn = content_fn = None
       if mime_type != "application/pdf":
-        content = self.to_pdf(digest, content, mime_type)
+        # The PDF is read straight from the cache when already converted.
+        pdf_fn = self.cache.get_path("pdf:" + digest)
 
-      in_fn = make_temp_file(content)
-      output = subprocess.check_output(['pdfinfo', in_fn])
-      ret = {}
-      for line in output.split("\n"):
-        if ":" in line:
-          key, value = line.strip().split(":", 1)
-          ret["PDF:" + key] = unicode(value.strip(), errors="replace")
+      if pdf_fn is None:
+        content_fn = make_temp_file(content)
+      try:
+        if pdf_fn is None:
+          pdf_fn = content_fn
+          if mime_type != "application/pdf":
+            pdf_fn = self.to_pdf_file(digest, content_fn, mime_type)
+        metadata = pdf_metadata(pdf_fn)
+      finally:
+        if content_fn is not None:
+          os.remove(content_fn)
 
-      os.remove(in_fn)
-      return ret
+    return self._set_cached_metadata(digest, metadata)
 
-    return {}
+  def get_metadata_file(self, digest, in_fn, mime_type):
+    """Path-based version of :meth:`get_metadata`."""
+    metadata = self._get_cached_metadata(digest)
+    if metadata is not None:
+      return metadata
+
+    if mime_type.startswith("image/"):
+      metadata = image_metadata(in_fn)
+    else:
+      pdf_fn = in_fn
+      if mime_type != "application/pdf":
+        pdf_fn = self.to_pdf_file(digest, in_fn, mime_type)
+      metadata = pdf_metadata(pdf_fn)
+
+    return self._set_cached_metadata(digest, metadata)
+
+  def _get_cached_metadata(self, digest):
+    serialized = self.cache.get("meta:" + digest)
+    if serialized is None:
+      self.stats.incr("cache.miss", target="meta")
+      return None
+    self.stats.incr("cache.hit", target="meta")
+    return json.loads(serialized)
+
+  def _set_cached_metadata(self, digest, metadata):
+    """Stores `metadata` (normalized) in the cache, and returns it as it will
+    be read from the cache."""
+    metadata = normalize_metadata(metadata)
+    self.cache["meta:" + digest] = json.dumps(metadata)
+    return metadata
 
   @staticmethod
   def digest(blob):
+    """Legacy (MD5) digest of an in-memory blob.
+
+    Prefer :meth:`digest_file`, which doesn't need the whole content in memory.
+    """
     assert type(blob) in (str, unicode)
     if type(blob) == str:
       digest = hashlib.md5(blob).hexdigest()
@@ -245,193 +725,350 @@ class Converter(object):
       digest = hashlib.md5(blob.encode("utf8")).hexdigest()
     return digest
 
+  @staticmethod
+  def digest_file(source):
+    """Digest of `source` (a path or a file object), computed in chunks.
+
+    See :func:`yaka.core.util.stream_digest`.
+    """
+    return stream_digest(source)
+
+  def upgrade_digest(self, source):
+    """Returns the digest of `source` (see :meth:`digest_file`), and makes
+    cache entries stored under its legacy MD5 digest available under it.
+    """
+    digest, legacy_digest = stream_digest(source, legacy=True)
+    self.cache.set_alias(digest, legacy_digest)
+    return digest
+
+
+class ToolProcess(object):
+  """
+  A conversion tool running in a subprocess, with limits.
+
+  The tool runs in its own process group, so that the processes it starts
+  (ex: unoconv's office server) are killed along with it when the wall-clock
+  `timeout` is reached. `memory_limit` (address space, in bytes) and
+  `cpu_limit` (seconds) are enforced by the kernel (`setrlimit`).
+
+  Other arguments are passed to :class:`subprocess.Popen`.
+  """
+
+  #: Seconds between SIGTERM and SIGKILL when killing the tool.
+  grace_period = 2
+
+  def __init__(self, cmd, timeout=None, memory_limit=None, cpu_limit=None,
+               **popen_kw):
+    self.cmd = cmd
+    self.timeout = timeout
+    self.timed_out = False
+    self.killed = False
+    preexec_fn = functools.partial(_limit_resources, memory_limit, cpu_limit)
+    try:
+      self.process = subprocess.Popen(cmd, preexec_fn=preexec_fn,
+                                      close_fds=True, **popen_kw)
+    except OSError, e:
+      raise ConversionError("Can't run {}: {}".format(cmd[0], e))
+
+    self._timer = None
+    if timeout:
+      self._timer = threading.Timer(timeout, self._on_timeout)
+      self._timer.daemon = True
+      self._timer.start()
+
+  @property
+  def stdout(self):
+    return self.process.stdout
+
+  def _on_timeout(self):
+    self.timed_out = True
+    self.kill()
+
+  def kill(self):
+    """Kills the tool and its children: SIGTERM, then SIGKILL if they're
+    still there after :attr:`grace_period`."""
+    self.killed = True
+    kill_process_group(self.process.pid, self.grace_period)
+
+  def communicate(self, input=None):
+    """Like :meth:`subprocess.Popen.communicate`, checking the exit
+    status."""
+    try:
+      out, err = self.process.communicate(input)
+    finally:
+      self._cancel_timer()
+    self._check()
+    return out, err
+
+  def wait(self, check=True):
+    """Waits for the tool to complete, and checks its exit status (unless
+    `check` is false)."""
+    try:
+      if self.process.stdout:
+        self.process.stdout.close()
+      status = self.process.wait()
+    finally:
+      self._cancel_timer()
+    if check:
+      self._check()
+    return status
+
+  def _cancel_timer(self):
+    if self._timer is not None:
+      self._timer.cancel()
+      if self.timed_out:
+        # Returns once the whole process group is killed.
+        self._timer.join()
+
+  def _check(self):
+    name = os.path.basename(self.cmd[0])
+    status = self.process.returncode
+    if self.timed_out:
+      raise ConversionTimeout("{} killed after {}s".format(name, self.timeout))
+    if status in (-signal.SIGKILL, -signal.SIGXCPU) or (
+        status < 0 and self.killed):
+      # SIGKILL without a timeout: most likely the OOM killer.
+      raise ProcessKilled("{} killed (signal {})".format(name, -status))
+    if status != 0:
+      raise ConversionError("{} failed (status: {})".format(name, status))
+
+
+def _limit_resources(memory_limit, cpu_limit):
+  """Runs in the child process, before the tool is executed."""
+  os.setsid()
+  if resource is None:
+    return
+  if memory_limit:
+    resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+  if cpu_limit:
+    # SIGXCPU at the soft limit, SIGKILL at the hard one.
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu_limit, cpu_limit + 5))
+
+
+def kill_process_group(pgid, grace_period=2):
+  """Sends SIGTERM to the process group `pgid`, then SIGKILL after
+  `grace_period` seconds if it still exists."""
+  try:
+    os.killpg(pgid, signal.SIGTERM)
+  except OSError:
+    return
+  deadline = time.time() + grace_period
+  while time.time() < deadline:
+    time.sleep(0.05)
+    try:
+      # Signal 0 only checks that the group still exists.
+      os.killpg(pgid, 0)
+    except OSError:
+      return
+  try:
+    os.killpg(pgid, signal.SIGKILL)
+  except OSError:
+    pass
+
 
 class Handler(object):
+  """Converts from `accepts_mime_types` to `produces_mime_types`.
+
+  Besides :meth:`convert`, which works on in-memory blobs, handlers provide
+  a path-based API: :meth:`convert_file` and :meth:`convert_to_file`. The
+  default implementations of the latter go through :meth:`convert`.
+  """
   __metaclass__ = ABCMeta
 
   accepts_mime_types = []
   produces_mime_types = []
 
+  #: True for handlers producing a series of documents (ex: page images),
+  #: which can't be intermediate steps of conversion chains.
+  multiple_outputs = False
+
+  #: Limits of the tools run by :meth:`run` and :meth:`spawn`: wall-clock
+  #: timeout (seconds), address space (bytes) and CPU time (seconds). `None`
+  #: means no limit. Can be overridden with the `CONVERSION_HANDLER_LIMITS`
+  #: setting.
+  run_timeout = 60
+  memory_limit = None
+  cpu_limit = None
+
   def __init__(self, *args, **kwargs):
     self.log = logger.getChild(self.__class__.__name__)
+    self._accepts_re = compile_patterns(self.accepts_mime_types)
+    self._produces_re = compile_patterns(self.produces_mime_types)
 
   def init_app(self, app):
     pass
 
+  def accepts(self, source_mime_type):
+    """True if this handler can convert from `source_mime_type`."""
+    return any(pat.match(source_mime_type) for pat in self._accepts_re)
+
+  def produces(self, target_mime_type):
+    """True if this handler can convert to `target_mime_type`."""
+    return any(pat.match(target_mime_type) for pat in self._produces_re)
+
   def accept(self, source_mime_type, target_mime_type):
     """Generic matcher based on patterns."""
+    return self.accepts(source_mime_type) and self.produces(target_mime_type)
 
-    match_source = False
-    match_target = False
+  @abstractmethod
+  def convert(self, key, **kw):
+    pass
 
-    for pat in self.accepts_mime_types:
-      if re.match("^%s$" % pat, source_mime_type):
-        match_source = True
-        break
+  def convert_file(self, in_fn, **kw):
+    """Converts the file at `in_fn`. Returns the same as :meth:`convert`."""
+    with open(in_fn, 'rb') as fd:
+      return self.convert(fd.read(), **kw)
 
-    for pat in self.produces_mime_types:
-      if re.match("^%s$" % pat, target_mime_type):
-        match_target = True
-        break
+  def convert_to_file(self, in_fn, out_fn, **kw):
+    """Converts the file at `in_fn`, writing the result to `out_fn`.
 
-    return match_source and match_target
+    Only makes sense for handlers producing a single document.
+    """
+    converted = self.convert_file(in_fn, **kw)
+    if isinstance(converted, unicode):
+      converted = converted.encode("utf8")
+    with open(out_fn, 'wb') as fd:
+      fd.write(converted)
+
+  def spawn(self, cmd, **popen_kw):
+    """Starts `cmd` with this handler's limits. Returns a
+    :class:`ToolProcess`."""
+    return ToolProcess(cmd, timeout=self.run_timeout,
+                       memory_limit=self.memory_limit,
+                       cpu_limit=self.cpu_limit, **popen_kw)
+
+  def run(self, cmd, **popen_kw):
+    """Runs `cmd` with this handler's limits, until it completes. Returns
+    its output if `stdout=subprocess.PIPE` is passed.
+
+    Raises :class:`ConversionError` if the tool fails,
+    :class:`ProcessKilled` / :class:`ConversionTimeout` if it is killed.
+    """
+    out, _ = self.spawn(cmd, **popen_kw).communicate()
+    return out
 
-  @abstractmethod
-  def convert(self, key, **kw):
-    pass
 
+class FileHandler(Handler):
+  """Base class for handlers that run external tools on files.
 
-class PdfToTextHandler(Handler):
-  accepts_mime_types = ['application/pdf']
-  produces_mime_types = ['text/plain']
+  Subclasses implement :meth:`convert_file` or :meth:`convert_to_file` (or
+  both); blobs passed to :meth:`convert` are written to a temporary file
+  first.
+  """
+
+  #: Suffix of the temporary input file (some tools need it).
+  in_suffix = ""
 
   def convert(self, blob, **kw):
-    in_fn = make_temp_file(blob)
+    in_fn = make_temp_file(blob, suffix=self.in_suffix)
+    try:
+      return self.convert_file(in_fn, **kw)
+    finally:
+      os.remove(in_fn)
+
+  def convert_file(self, in_fn, **kw):
     fd, out_fn = mkstemp(dir=TMP_DIR)
     os.close(fd)
-
     try:
-      try:
-        subprocess.check_call(['pdftotext', in_fn, out_fn])
-      except Exception, e:
-        raise ConversionError(e)
+      self.convert_to_file(in_fn, out_fn, **kw)
+      return open(out_fn, 'rb').read()
+    finally:
+      os.remove(out_fn)
 
-      converted = open(out_fn).read()
-      encoding = encoding_sniffer.from_file(out_fn)
 
-      if encoding in ("binary", None):
-        encoding = "ascii"
-      try:
-        converted_unicode = unicode(converted, encoding, errors="ignore")
-      except:
-        traceback.print_exc()
-        converted_unicode = unicode(converted, errors="ignore")
+class PdfToTextHandler(FileHandler):
+  accepts_mime_types = ['application/pdf']
+  produces_mime_types = ['text/plain']
 
-      return converted_unicode
-    finally:
-      os.remove(in_fn)
-      os.remove(out_fn)
+  def convert_file(self, in_fn, **kw):
+    converted = self.run(['pdftotext', in_fn, '-'], stdout=subprocess.PIPE)
+    return decode_text(converted)
 
 
-class AbiwordTextHandler(Handler):
+class AbiwordTextHandler(FileHandler):
   accepts_mime_types = ['application/msword']
   produces_mime_types = ['text/plain']
+  in_suffix = ".doc"
 
-  def convert(self, blob, **kw):
-    in_fn = make_temp_file(blob, suffix=".doc")
+  def convert_file(self, in_fn, **kw):
     out_fn = mktemp(dir=TMP_DIR, suffix='.txt')
-
-    cur_dir = os.getcwd()
     try:
-      try:
-        os.chdir(TMP_DIR)
-        subprocess.check_call(
-          ['abiword', '--to', os.path.basename(out_fn), os.path.basename(in_fn)])
-      except Exception, e:
-        raise ConversionError(e)
-      finally:
-        os.chdir(cur_dir)
-
-      converted = open(out_fn).read()
-      encoding = encoding_sniffer.from_file(out_fn)
-
-      if encoding in ("binary", None):
-        encoding = "ascii"
-      try:
-        converted_unicode = unicode(converted, encoding, errors="ignore")
-      except:
-        traceback.print_exc()
-        converted_unicode = unicode(converted, errors="ignore")
-
-      return converted_unicode
+      run_abiword(self, in_fn, out_fn)
+      return decode_text(open(out_fn).read())
     finally:
-      os.remove(in_fn)
       if os.path.exists(out_fn):
         os.remove(out_fn)
 
 
-class AbiwordPDFHandler(Handler):
+class AbiwordPDFHandler(FileHandler):
   accepts_mime_types = ['application/msword',
                         'application/vnd.oasis.opendocument.text',
                         'text/rtf',]
   produces_mime_types = ['application/pdf']
+  in_suffix = ".doc"
 
-  def convert(self, blob, **kw):
-    in_fn = make_temp_file(blob, suffix=".doc")
-    out_fn = mktemp(dir=TMP_DIR, suffix='.pdf')
-
-    cur_dir = os.getcwd()
+  def convert_to_file(self, in_fn, out_fn, **kw):
+    # abiword guesses the output format from the file extension.
+    pdf_fn = mktemp(dir=TMP_DIR, suffix='.pdf')
     try:
-      try:
-        os.chdir(TMP_DIR)
-        subprocess.check_call(
-          ['abiword', '--to', os.path.basename(out_fn), os.path.basename(in_fn)])
-      except Exception, e:
-        raise ConversionError(e)
-      finally:
-        os.chdir(cur_dir)
-
-      converted = open(out_fn).read()
-      return converted
+      run_abiword(self, in_fn, pdf_fn)
+      shutil.move(pdf_fn, out_fn)
     finally:
-      os.remove(in_fn)
-      if os.path.exists(out_fn):
-        os.remove(out_fn)
+      if os.path.exists(pdf_fn):
+        os.remove(pdf_fn)
 
 
-class ImageMagickHandler(Handler):
+class ImageMagickHandler(FileHandler):
   accepts_mime_types = ['image/.*']
   produces_mime_types = ['application/pdf']
+  # Crafted images can make ImageMagick allocate gigabytes.
+  run_timeout = 30
+  memory_limit = 2 << 30
+  cpu_limit = 30
 
-  def convert(self, blob, **kw):
-    in_fn = make_temp_file(blob)
-    out_fn = mktemp(dir=TMP_DIR)
-
-    try:
-      subprocess.check_call(['convert', in_fn, "pdf:" + out_fn])
-
-      converted = open(out_fn).read()
-      return converted
-    except Exception, e:
-      raise ConversionError(e)
-    finally:
-      os.remove(in_fn)
-      os.remove(out_fn)
+  def convert_to_file(self, in_fn, out_fn, **kw):
+    self.run(['convert', in_fn, "pdf:" + out_fn])
 
 
-class PdfToPpmHandler(Handler):
+class PdfToPpmHandler(FileHandler):
   accepts_mime_types = ['application/pdf']
   produces_mime_types = ['image/jpeg']
+  memory_limit = 2 << 30
+  multiple_outputs = True
 
-  def convert(self, blob, size=500):
+  def convert_file(self, in_fn, size=500, max_pages=None):
     """Size is the maximum horizontal size."""
 
-    in_fn = make_temp_file(blob)
-    out_fn = mktemp(dir=TMP_DIR)
-    l = []
+    cmd = ['pdftoppm', in_fn]
+    if max_pages:
+      cmd[1:1] = ['-l', str(max_pages)]
 
+    # Pages are streamed from pdftoppm's stdout, as raw PPM images.
+    process = self.spawn(cmd, stdout=subprocess.PIPE, bufsize=-1)
+    converted_images = []
     try:
-      subprocess.check_call(['pdftoppm', '-jpeg', in_fn, out_fn])
-
-      l = glob.glob("%s-*.jpg" % out_fn)
-      l.sort()
-      converted_images = []
-      for fn in l:
-        converted = resize(open(fn).read(), size)
-        converted_images.append(converted)
-
-      return converted_images
-    except Exception, e:
-      raise ConversionError(e)
-    finally:
-      for fn in itertools.chain([in_fn, out_fn], l):
-        try:
-          os.remove(fn)
-        except OSError:
-            pass
-
-
-class UnoconvPdfHandler(Handler):
+      for image in iter_ppm_images(process.stdout):
+        x, y = image.size
+        if x > size:
+          image.thumbnail((size, int(1.0 * y * size / x)), Image.ANTIALIAS)
+        output = StringIO.StringIO()
+        image.save(output, "JPEG")
+        converted_images.append(output.getvalue())
+    except Exception:
+      # Don't wait for the tool to finish a document we won't read.
+      process.kill()
+      process.wait(check=False)
+      raise
+
+    process.wait()
+    return converted_images
+
+  def convert_to_file(self, in_fn, out_fn, **kw):
+    # Not an intermediate step of chains, see multiple_outputs.
+    raise ConversionError("pdftoppm produces a series of images")
+
+
+class UnoconvPdfHandler(FileHandler):
   """Handles conversion from office documents (MS-Office, OOo) to PDF.
 
   Uses unoconv.
@@ -445,8 +1082,6 @@ class UnoconvPdfHandler(Handler):
                         'application/vnd.openxmlformats-officedocument.*',
                         'text/rtf']
   produces_mime_types = ['application/pdf']
-  run_timeout = 60
-  _process = None
   unoconv = 'unoconv'
 
   def init_app(self, app):
@@ -480,51 +1115,33 @@ class UnoconvPdfHandler(Handler):
     else:
       cmd = [self.unoconv, '--version']
 
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    out, err = process.communicate()
-    return out
+    return self.run(cmd, stdout=subprocess.PIPE)
 
-  def convert(self, blob, **kw):
+  def convert_to_file(self, in_fn, out_fn, **kw):
     "Unoconv converter called"
-    in_fn = make_temp_file(blob)
-    out_fd, out_fn = mkstemp(prefix='tmp-unoconv-', suffix=".pdf", dir=TMP_DIR)
-    os.close(out_fd)
+    # unoconv is run from TMP_DIR: paths must be absolute.
+    in_fn = os.path.abspath(in_fn)
+    out_fn = os.path.abspath(out_fn)
+
+    # unoconv wants a ".pdf" output file name; writing next to `out_fn` makes
+    # the final rename cheap.
+    pdf_fd, pdf_fn = mkstemp(prefix='tmp-unoconv-', suffix=".pdf",
+                             dir=os.path.dirname(out_fn))
+    os.close(pdf_fd)
 
     # Hack for my Mac, FIXME later
     if os.path.exists("/Applications/LibreOffice.app/Contents/program/python"):
       cmd = ['/Applications/LibreOffice.app/Contents/program/python',
-             '/usr/local/bin/unoconv', '-f', 'pdf', '-o', out_fn, in_fn]
+             '/usr/local/bin/unoconv', '-f', 'pdf', '-o', pdf_fn, in_fn]
     else:
-      cmd = [self.unoconv, '-f', 'pdf', '-o', out_fn, in_fn]
-
-    def run_uno():
-      self._process = subprocess.Popen(cmd, close_fds=True, cwd=TMP_DIR)
-      try:
-        self._process.communicate()
-      except Exception, e:
-        raise ConversionError(e)
-
-    run_thread = threading.Thread(target=run_uno)
-    run_thread.start()
-    run_thread.join(self.run_timeout)
+      cmd = [self.unoconv, '-f', 'pdf', '-o', pdf_fn, in_fn]
 
     try:
-      if run_thread.is_alive():
-        # timeout reached
-        self._process.terminate()
-        if not self._process.poll() is None:
-          self._process.kill()
-
-        self._process = None
-        raise ConversionError("Conversion timeout ({})".format(self.run_timeout))
-
-      converted = open(out_fn).read()
-      return converted
-
+      self.run(cmd, cwd=TMP_DIR)
+      os.rename(pdf_fn, out_fn)
     finally:
-      self._process = None
-      os.remove(in_fn)
-      os.remove(out_fn)
+      if os.path.exists(pdf_fn):
+        os.remove(pdf_fn)
 
 
 class CloudoooPdfHandler(Handler):
@@ -573,37 +1190,26 @@ class CloudoooPdfHandler(Handler):
     return new_key
 
 
-class WvwareTextHandler(Handler):
+class WvwareTextHandler(FileHandler):
   accepts_mime_types = ['application/msword']
   produces_mime_types = ['text/plain']
 
-  def convert(self, blob, **kw):
-    in_fn = make_temp_file(blob)
+  def convert_file(self, in_fn, **kw):
     out_fn = mktemp(dir=TMP_DIR)
 
     try:
-      try:
-        subprocess.check_call(['wvText', in_fn, out_fn])
-      except Exception, e:
-        raise ConversionError(e)
-
-      converted = open(out_fn).read()
-
-      encoding = encoding_sniffer.from_file(out_fn)
-      if encoding in ("binary", None):
-        encoding = "ascii"
-      try:
-        converted_unicode = unicode(converted, encoding, errors="ignore")
-      except:
-        traceback.print_exc()
-        converted_unicode = unicode(converted, errors="ignore")
-
-      return converted_unicode
+      self.run(['wvText', in_fn, out_fn])
+      return decode_text(open(out_fn).read())
     finally:
-      os.remove(in_fn)
-      os.remove(out_fn)
+      if os.path.exists(out_fn):
+        os.remove(out_fn)
 
 # Utils
+def compile_patterns(patterns):
+  """Compiles mime type patterns, anchored at both ends."""
+  return [re.compile("^%s$" % pat) for pat in patterns]
+
+
 def make_temp_file(blob, prefix='tmp', suffix=""):
   if not os.path.exists(TMP_DIR):
     os.mkdir(TMP_DIR)
@@ -613,6 +1219,127 @@ def make_temp_file(blob, prefix='tmp', suffix=""):
   fd.close()
   return in_fn
 
+
+def image_metadata(source):
+  """EXIF metadata of the image in `source` (a path or a file object)."""
+  img = Image.open(source)
+  ret = {}
+  if not hasattr(img, '_getexif'):
+    return {}
+  info = img._getexif()
+  if not info:
+    return {}
+  for tag, value in info.items():
+    decoded = TAGS.get(tag, tag)
+    ret["EXIF:" + str(decoded)] = value
+  return ret
+
+
+def pdf_metadata(pdf_fn, timeout=30):
+  """Metadata of the PDF file at `pdf_fn`, as reported by `pdfinfo`."""
+  process = ToolProcess(['pdfinfo', pdf_fn], timeout=timeout,
+                        stdout=subprocess.PIPE)
+  output, _ = process.communicate()
+  ret = {}
+  for line in output.split("\n"):
+    if ":" in line:
+      key, value = line.strip().split(":", 1)
+      ret["PDF:" + key] = unicode(value.strip(), errors="replace")
+  return ret
+
+
+def normalize_metadata(value):
+  """Converts metadata values to JSON types: tuples become lists, byte
+  strings are decoded (UTF-8 if possible, Latin-1 otherwise), and other
+  numbers (ex: EXIF rationals) become floats."""
+  if isinstance(value, dict):
+    return dict((unicode(k), normalize_metadata(v)) for k, v in value.items())
+  elif isinstance(value, (list, tuple)):
+    return [normalize_metadata(v) for v in value]
+  elif isinstance(value, str):
+    try:
+      return value.decode("utf8")
+    except UnicodeDecodeError:
+      return value.decode("latin1")
+  elif value is None or isinstance(value, (unicode, bool, int, long, float)):
+    return value
+  try:
+    return float(value)
+  except (TypeError, ValueError):
+    return unicode(repr(value))
+
+
+def remove_files(filenames):
+  for fn in filenames:
+    try:
+      os.remove(fn)
+    except OSError:
+      pass
+
+
+def decode_text(converted):
+  """Decodes text output by conversion tools, sniffing its encoding."""
+  encoding = encoding_sniffer.from_buffer(converted)
+  if encoding in ("binary", None):
+    encoding = "ascii"
+  try:
+    converted_unicode = unicode(converted, encoding, errors="ignore")
+  except:
+    traceback.print_exc()
+    converted_unicode = unicode(converted, errors="ignore")
+
+  return converted_unicode
+
+
+def run_abiword(handler, in_fn, out_fn):
+  """Runs abiword (from TMP_DIR), with the limits of `handler`, to convert
+  `in_fn` to `out_fn`. The output format is guessed from the `out_fn`
+  extension."""
+  in_fn = os.path.abspath(in_fn)
+  out_fn = os.path.abspath(out_fn)
+  handler.run(['abiword', '--to', out_fn, in_fn], cwd=TMP_DIR)
+
+
+def iter_ppm_images(stream):
+  """Yields PIL images read from `stream`, a series of binary PPM (P6) images
+  such as the output of `pdftoppm` on stdout.
+
+  Only one image is kept in memory at a time.
+  """
+  while True:
+    tokens = []
+    token = ""
+    # Header: magic number, width, height, maxval, then a single whitespace.
+    while len(tokens) < 4:
+      c = stream.read(1)
+      if not c:
+        if tokens or token:
+          raise ConversionError("Truncated PPM stream")
+        return
+      if c == "#" and not token:
+        stream.readline()
+      elif c.isspace():
+        if token:
+          tokens.append(token)
+          token = ""
+      else:
+        token += c
+
+    magic, width, height, maxval = tokens[0], int(tokens[1]), \
+                                   int(tokens[2]), int(tokens[3])
+    if magic != "P6":
+      raise ConversionError("Unsupported PPM format: %r" % magic)
+
+    length = width * height * (3 if maxval < 256 else 6)
+    data = stream.read(length)
+    if len(data) != length:
+      raise ConversionError("Truncated PPM stream")
+
+    header = "P6\n%d %d\n%d\n" % (width, height, maxval)
+    image = Image.open(StringIO.StringIO(header + data))
+    image.load()
+    yield image
+
 # Singleton, yuck!
 converter = Converter()
 converter.register_handler(PdfToTextHandler())
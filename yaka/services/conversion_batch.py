@@ -0,0 +1,209 @@
+"""
+Batch conversions, to pre-warm the conversion cache (ex: after deploying a new
+conversion stack or wiping the cache), and batch metadata extraction.
+
+Documents are given as `(digest, path, mime_type)` items; `digest` and
+`mime_type` may be `None`, in which case they are computed from the file.
+See :func:`iter_directory` and :func:`iter_manifest`.
+
+Runs are resumable: documents whose results are already cached are skipped,
+and a state file can record processed documents (including failed ones).
+"""
+
+import logging
+import os
+import time
+from multiprocessing.pool import ThreadPool
+
+from yaka.core.util import stream_digest
+
+from .conversion import converter as default_converter, mime_sniffer
+
+__all__ = ['warm_up', 'extract_metadata', 'iter_directory', 'iter_manifest']
+
+logger = logging.getLogger(__name__)
+
+TARGETS = ('pdf', 'text', 'image')
+
+CONVERTED = "converted"
+SKIPPED = "skipped"
+FAILED = "failed"
+
+
+def iter_directory(root):
+  """Yields items for all the files under `root`."""
+  for dirpath, dirnames, filenames in os.walk(root):
+    dirnames.sort()
+    for filename in sorted(filenames):
+      yield None, os.path.join(dirpath, filename), None
+
+
+def iter_manifest(lines):
+  """Yields items from `lines` of the form "digest path [mime_type]",
+  separated by whitespace. Blank lines and lines starting with "#" are
+  ignored."""
+  for line in lines:
+    line = line.strip()
+    if not line or line.startswith("#"):
+      continue
+    fields = line.split(None, 2)
+    if len(fields) < 2:
+      raise ValueError("Invalid manifest line: %r" % line)
+    digest, path = fields[0], fields[1]
+    mime_type = fields[2] if len(fields) > 2 else None
+    yield digest, path, mime_type
+
+
+def load_state(state_file):
+  """Returns the set of digests and paths recorded in `state_file`."""
+  done = set()
+  if state_file and os.path.exists(state_file):
+    with open(state_file) as fd:
+      for line in fd:
+        fields = line.rstrip("\n").split("\t")
+        done.update(fields[:2])
+  return done
+
+
+def resolve_item(item, legacy_digest=True):
+  """Computes the digest and mime type of `item` if missing."""
+  digest, path, mime_type = item
+  if digest is None:
+    # Callers usually key the cache on Converter.digest() (MD5).
+    new_digest, md5_digest = stream_digest(path, legacy=True)
+    digest = md5_digest if legacy_digest else new_digest
+  if mime_type is None:
+    mime_type = mime_sniffer.from_file(path)
+  return digest, path, mime_type
+
+
+def warm_up_one(converter, item, targets=TARGETS, pages=1, size=500,
+                legacy_digest=True):
+  """Converts one document to each of `targets`, unless already cached.
+
+  Returns `(status, digest, path, error)`.
+  """
+  digest, path, mime_type = item
+  try:
+    digest, path, mime_type = resolve_item(item, legacy_digest)
+    cache = converter.cache
+    is_image = mime_type.startswith("image/")
+    status = SKIPPED
+
+    if ('pdf' in targets and mime_type != "application/pdf"
+        and "pdf:" + digest not in cache):
+      converter.to_pdf_file(digest, path, mime_type)
+      status = CONVERTED
+
+    if 'text' in targets and not is_image and "txt:" + digest not in cache:
+      converter.to_text_file(digest, path, mime_type)
+      status = CONVERTED
+
+    if 'image' in targets and not is_image:
+      # Shorter documents have fewer previews.
+      last_page = min(pages, converter.page_count(digest) or pages) - 1
+      if "img:%s:%s:%s" % (last_page, size, digest) not in cache:
+        converter.to_images_file(digest, path, mime_type, size=size,
+                                 max_pages=pages)
+        status = CONVERTED
+
+    return status, digest, path, None
+  except Exception, e:
+    logger.warning("Conversion failed for %s (%s): %s", path, digest, e)
+    return FAILED, digest, path, e
+
+
+def warm_up(items, converter=None, targets=TARGETS, pages=1, size=500,
+            workers=4, state_file=None, legacy_digest=True,
+            report_interval=10, report=None):
+  """Runs conversions for all `items`, across a pool of `workers` threads
+  (the conversions themselves run in subprocesses).
+
+  - `targets`: some of "pdf", "text", "image".
+  - `pages`, `size`: number and width of the page previews to render.
+  - `state_file`: where processed documents are recorded; documents already
+    recorded there are skipped.
+  - `legacy_digest`: whether computed digests are MD5 (like
+    :meth:`Converter.digest`) or streaming ones.
+  - `report`: called with a progress summary dict every `report_interval`
+    seconds and at the end. Defaults to logging.
+
+  Returns the final summary dict.
+  """
+  if converter is None:
+    converter = default_converter
+  if report is None:
+    report = lambda summary: logger.info(format_summary(summary))
+
+  done = load_state(state_file)
+  items = [item for item in items
+           if item[0] not in done and item[1] not in done]
+
+  summary = dict(total=len(items), processed=0, elapsed=0.0,
+                 rate=0.0, **{CONVERTED: 0, SKIPPED: 0, FAILED: 0})
+
+  def run(item):
+    return warm_up_one(converter, item, targets=targets, pages=pages,
+                       size=size, legacy_digest=legacy_digest)
+
+  state_fd = open(state_file, "a") if state_file else None
+  pool = ThreadPool(workers)
+  start = last_report = time.time()
+  try:
+    for status, digest, path, error in pool.imap_unordered(run, items):
+      summary[status] += 1
+      summary['processed'] += 1
+      if state_fd:
+        state_fd.write("%s\t%s\t%s\n" % (digest or "", path, status))
+        state_fd.flush()
+
+      now = time.time()
+      if now - last_report >= report_interval:
+        last_report = now
+        _update_rate(summary, now - start)
+        report(summary)
+  finally:
+    pool.terminate()
+    if state_fd:
+      state_fd.close()
+
+  _update_rate(summary, time.time() - start)
+  report(summary)
+  return summary
+
+
+def extract_metadata(items, converter=None, workers=4, legacy_digest=True):
+  """Extracts (and caches) the metadata of all `items` across a pool of
+  `workers` threads.
+
+  Returns a dict: digest => metadata dict, or `None` when extraction failed.
+  """
+  if converter is None:
+    converter = default_converter
+
+  def run(item):
+    digest = item[0]
+    try:
+      digest, path, mime_type = resolve_item(item, legacy_digest)
+      return digest, converter.get_metadata_file(digest, path, mime_type)
+    except Exception, e:
+      logger.warning("Metadata extraction failed for %s (%s): %s",
+                     item[1], digest, e)
+      return digest, None
+
+  pool = ThreadPool(workers)
+  try:
+    return dict(pool.imap_unordered(run, items))
+  finally:
+    pool.terminate()
+
+
+def _update_rate(summary, elapsed):
+  summary['elapsed'] = elapsed
+  summary['rate'] = summary['processed'] / elapsed if elapsed else 0.0
+
+
+def format_summary(summary):
+  return ("{processed}/{total} documents ({converted} converted, "
+          "{skipped} already cached, {failed} failed) "
+          "in {elapsed:.1f}s, {rate:.2f} documents/s".format(**summary))
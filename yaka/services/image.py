@@ -1,66 +1,365 @@
 """
 Provides tools (currently: only functions, not a real service) for image
 processing.
+
+Results are cached in a two-tier :class:`ImageCache`: a bounded in-memory LRU
+in front of an on-disk, content-addressed store.
+
+Output images are JPEG (or PNG for images with transparency) unless another
+format is requested; views can use :func:`negotiate_format` to serve WebP to
+browsers that accept it. Metadata (EXIF...) is stripped.
 """
 
+import logging
+import math
+import os
+import threading
+from collections import OrderedDict
 from cStringIO import StringIO
-from PIL import Image
+from tempfile import mkstemp
+
+from flask import request
+from PIL import Image, ImageFile
+
+from yaka.core.util import new_hash
+
+__all__ = ['resize', 'crop_and_resize', 'thumbnails', 'negotiate_format',
+           'mime_type', 'ImageCache']
+
+logger = logging.getLogger(__name__)
+
+#: Default size of the in-memory cache, in bytes.
+MEMORY_CACHE_SIZE = 32 << 20
+
+#: Default directory of the on-disk cache (next to the conversion cache). Can
+#: be overridden with the `IMAGE_CACHE_DIR` setting (`None`: memory only).
+CACHE_DIR = os.path.join("cache", "images")
+
+#: Output formats => mime type.
+FORMATS = {
+  "JPEG": "image/jpeg",
+  "PNG": "image/png",
+  "WEBP": "image/webp",
+}
+
+#: Default encoding quality, per format. Can be overridden with the
+#: `IMAGE_QUALITY` setting.
+QUALITY = {
+  "JPEG": 85,
+  "WEBP": 80,
+}
+
+
+class ImageCache(object):
+  """
+  Image cache: an in-memory LRU bounded by the total size of its entries,
+  backed by files under `directory` (if not `None`).
+
+  Keys are strings built from the digest of the original image and the
+  processing parameters (see :func:`cache_key`). Files are never evicted by
+  this class: they can be removed at any time (ex: by a cron job).
+  """
+
+  def __init__(self, directory=None, max_bytes=MEMORY_CACHE_SIZE):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.size = 0
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  def init_app(self, app):
+    self.directory = app.config.get('IMAGE_CACHE_DIR', CACHE_DIR)
+    self.max_bytes = app.config.get('IMAGE_CACHE_MEMORY_SIZE', self.max_bytes)
+
+  def _path(self, key):
+    return os.path.join(self.directory, key[:2], key)
+
+  def get(self, key):
+    """Returns the value cached under `key`, or `None`."""
+    with self._lock:
+      value = self._entries.pop(key, None)
+      if value is not None:
+        # Most recently used entries are at the end.
+        self._entries[key] = value
+        return value
+
+    if self.directory is None:
+      return None
+    try:
+      with open(self._path(key), 'rb') as fd:
+        value = fd.read()
+    except IOError:
+      return None
+    self._remember(key, value)
+    return value
+
+  def set(self, key, value):
+    self._remember(key, value)
+    if self.directory is not None:
+      try:
+        self._write(key, value)
+      except (IOError, OSError), e:
+        logger.warning("Can't write image cache entry %s: %s", key, e)
+
+  def _remember(self, key, value):
+    if len(value) > self.max_bytes:
+      return
+    with self._lock:
+      previous = self._entries.pop(key, None)
+      if previous is not None:
+        self.size -= len(previous)
+      self._entries[key] = value
+      self.size += len(value)
+      while self.size > self.max_bytes:
+        _, evicted = self._entries.popitem(last=False)
+        self.size -= len(evicted)
+
+  def _write(self, key, value):
+    path = self._path(key)
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+      try:
+        os.makedirs(dirname)
+      except OSError:
+        # Created concurrently.
+        if not os.path.isdir(dirname):
+          raise
+    # Write then rename, so that readers never see partial files.
+    fd, tmp_fn = mkstemp(dir=dirname, suffix=".tmp")
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        f.write(value)
+      os.rename(tmp_fn, path)
+    except:
+      os.remove(tmp_fn)
+      raise
+
+  def __contains__(self, key):
+    with self._lock:
+      if key in self._entries:
+        return True
+    return self.directory is not None and os.path.exists(self._path(key))
+
+  def clear(self):
+    """Clears the in-memory cache (files are kept)."""
+    with self._lock:
+      self._entries.clear()
+      self.size = 0
+
+
+cache = ImageCache()
+
+
+def init_app(app):
+  cache.init_app(app)
+  QUALITY.update(app.config.get('IMAGE_QUALITY', {}))
+
 
-import hashlib
+def supported_formats():
+  """Output formats supported by the installed PIL."""
+  Image.init()
+  return [format for format in FORMATS if format in Image.SAVE]
 
-__all__ = ['resize', 'crop_and_resize']
 
-# TODO: cache to file
-cache = {}
+def negotiate_format(accept=None):
+  """Returns the best output format for the current request, according to
+  its "Accept" header (or `accept`, a :class:`werkzeug.MIMEAccept`): "WEBP"
+  if the browser explicitly accepts it and PIL can write it, `None` (the
+  default format) otherwise.
 
+  Responses should then have a "Vary: Accept" header.
+  """
+  if accept is None:
+    accept = request.accept_mimetypes
+  # Only explicit mentions count: "*/*" doesn't mean WebP is supported.
+  for value, quality in accept:
+    if value == "image/webp" and quality > 0:
+      if "WEBP" in supported_formats():
+        return "WEBP"
+      break
+  return None
 
-def resize(orig, hsize):
-  cache_key = (hashlib.md5(orig).digest(), hsize, hsize)
-  if cache_key in cache:
-    return cache[cache_key]
 
+def mime_type(data):
+  """Mime type of the image `data` returned by this module."""
+  if data.startswith("\x89PNG"):
+    return "image/png"
+  elif data.startswith("RIFF") and data[8:12] == "WEBP":
+    return "image/webp"
+  elif data.startswith("\xff\xd8"):
+    return "image/jpeg"
+  return "application/octet-stream"
+
+
+def cache_key(digest, operation, *params):
+  """Cache key of the result of `operation` with `params` on the image whose
+  (hex) digest is `digest`."""
+  return "-".join([digest, operation] + [str(p) for p in params])
+
+
+def resize(orig, hsize, digest=None, format=None, quality=None):
+  """Resizes `orig` to `hsize` pixels wide, keeping proportions.
+
+  `digest` (hex), if the caller already knows it, saves hashing `orig` again.
+  See :func:`encode` for `format` and `quality`.
+  """
+  return thumbnails(orig, [(hsize, 0)], digest, format, quality)[0]
+
+
+def crop_and_resize(orig, hsize, vsize=0, digest=None, format=None,
+                    quality=None):
+  """Crops `orig` to the proportions of `hsize` x `vsize` (centered), and
+  resizes it to that size. `vsize` defaults to `hsize` (square)."""
+  return thumbnails(orig, [(hsize, vsize or hsize)], digest, format,
+                    quality)[0]
+
+
+def thumbnails(orig, sizes, digest=None, format=None, quality=None):
+  """Returns thumbnails of `orig` for each `(hsize, vsize)` in `sizes`, ex:
+  avatar, list and preview sizes for a photo. The original is decoded at
+  most once, whatever the number of sizes.
+
+  A `vsize` of 0 means :func:`resize` to `hsize`, otherwise
+  :func:`crop_and_resize` to `hsize` x `vsize`. See :func:`encode` for
+  `format` and `quality`.
+  """
+  digest = digest or new_hash(orig).hexdigest()
+  options = (format or "auto", quality or "")
+  keys = [cache_key(digest, "c", hsize, vsize, *options) if vsize
+          else cache_key(digest, "r", hsize, *options)
+          for hsize, vsize in sizes]
+  results = [cache.get(key) for key in keys]
+  missing = [i for i, result in enumerate(results) if result is None]
+  if not missing:
+    return results
+
+  # Only reads the header: the bitmap is decoded on first access.
   image = Image.open(StringIO(orig))
-  x, y = image.size
+  width, height = image.size
+  # Small originals are served as is, if they don't need re-encoding.
+  keep_orig = (image.format == (format or default_format(image))
+               and "exif" not in image.info)
+  ratios = []
+  for i in missing:
+    hsize, vsize = sizes[i]
+    if vsize:
+      ratios.append(min(1.0 * width / hsize, 1.0 * height / vsize))
+    elif width > hsize:
+      ratios.append(1.0 * width / hsize)
+    elif not keep_orig:
+      # Re-encoded at full size.
+      ratios.append(1)
+  if ratios:
+    image = decode(image, min(ratios))
+
+  for i in missing:
+    hsize, vsize = sizes[i]
+    if vsize:
+      thumbnail = _crop_and_resize(image, hsize, vsize)
+    elif width <= hsize:
+      if keep_orig:
+        # Cached too, so the next call doesn't need to parse the image.
+        cache.set(keys[i], orig)
+        results[i] = orig
+        continue
+      thumbnail = decode(image)
+    else:
+      thumbnail = image.copy()
+      thumbnail.thumbnail((hsize, int(1.0 * height * hsize / width)),
+                          Image.ANTIALIAS)
+    results[i] = encode(thumbnail, format, quality)
+    cache.set(keys[i], results[i])
+
+  return results
+
 
-  if x <= hsize:
-    return orig
+def decode(image, ratio=1):
+  """Decodes `image`, which is going to be scaled down by `ratio`.
 
-  x1 = hsize
-  y1 = int(1.0 * y * hsize / x)
-  image.thumbnail((x1, y1), Image.ANTIALIAS)
+  JPEG images are decoded at a lower resolution when possible (downscaling
+  by 2, 4 or 8 in the DCT domain), which is much faster and uses less
+  memory. The decoded image is at least `1 / ratio` times the original
+  size, so thumbnails don't lose quality.
+  """
+  if image.format == "JPEG" and ratio >= 2:
+    width, height = image.size
+    image.draft(image.mode, (int(math.ceil(width / ratio)),
+                             int(math.ceil(height / ratio))))
+  image.load()
+  return image
+
+
+def has_alpha(image):
+  return (image.mode in ("RGBA", "LA")
+          or (image.mode == "P" and "transparency" in image.info))
+
+
+def default_format(image):
+  """PNG for images with transparency, JPEG otherwise."""
+  return "PNG" if has_alpha(image) else "JPEG"
+
+
+def encode(image, format=None, quality=None):
+  """Encodes `image` in `format` (one of :data:`FORMATS`, defaults to
+  :func:`default_format`), with `quality` (defaults to :data:`QUALITY`).
+
+  JPEG images are progressive and have optimized Huffman tables; images
+  with transparency are flattened on a white background. Metadata isn't
+  kept.
+  """
+  format = format or default_format(image)
+  if format not in FORMATS:
+    raise ValueError("Unsupported image format: {}".format(format))
+  quality = quality or QUALITY.get(format)
+
+  options = {}
+  if format == "JPEG":
+    image = _flatten(image)
+    options = dict(quality=quality, optimize=True, progressive=True)
+  elif format == "WEBP":
+    if image.mode not in ("RGB", "RGBA"):
+      image = image.convert("RGBA" if has_alpha(image) else "RGB")
+    options = dict(quality=quality)
+  else:
+    if image.mode not in ("1", "L", "LA", "P", "RGB", "RGBA"):
+      image = image.convert("RGB")
+    options = dict(optimize=True)
+
+  if options.get("optimize"):
+    # Optimized / progressive JPEGs are written in one block, which must be
+    # large enough.
+    width, height = image.size
+    ImageFile.MAXBLOCK = max(ImageFile.MAXBLOCK, width * height * 3)
   output = StringIO()
-  image.save(output, "JPEG")
-  converted = output.getvalue()
-  cache[cache_key] = converted
-  return converted
+  image.save(output, format, **options)
+  return output.getvalue()
 
 
-def crop_and_resize(orig, hsize, vsize=0):
-  if not vsize:
-    vsize = hsize
-  cache_key = (hashlib.md5(orig).digest(), hsize, vsize)
-  if cache_key in cache:
-    return cache[cache_key]
+def _flatten(image):
+  """Converts `image` to a mode JPEG supports, flattening transparency on a
+  white background."""
+  if has_alpha(image):
+    rgba = image.convert("RGBA")
+    flat = Image.new("RGB", rgba.size, (255, 255, 255))
+    flat.paste(rgba, mask=rgba.split()[3])
+    return flat
+  elif image.mode not in ("L", "RGB", "CMYK"):
+    return image.convert("RGB")
+  return image
 
-  image = Image.open(StringIO(orig))
 
+def _crop_and_resize(image, hsize, vsize):
   # Compute cropping coordinates
   x1 = y1 = 0
   x2, y2 = image.size
   w_ratio = 1.0 * x2 / hsize
   h_ratio = 1.0 * y2 / vsize
   if h_ratio > w_ratio:
-    y1 = int(y2 / 2 - hsize * w_ratio / 2)
+    y1 = int(y2 / 2 - vsize * w_ratio / 2)
     y2 = int(y2 / 2 + vsize * w_ratio / 2)
   else:
     x1 = int(x2 / 2 - hsize * h_ratio / 2)
-    x2 = int(x2 / 2 + vsize * h_ratio / 2)
+    x2 = int(x2 / 2 + hsize * h_ratio / 2)
   image = image.crop((x1, y1, x2, y2))
-
   image.thumbnail((hsize, vsize), Image.ANTIALIAS)
-
-  output = StringIO()
-  image.save(output, "JPEG")
-  converted = output.getvalue()
-  cache[cache_key] = converted
-  return converted
+  return image
@@ -0,0 +1,101 @@
+"""
+Activity Streams (JSON) feeds: activities of an actor, or on an object.
+
+Feeds are returned most recent first, and `before` (the id of the last
+entry of a page) gets older entries. Clients poll feeds with the `since`
+parameter (the id of the newest entry they have): entries more recent than
+this one are returned oldest first, and the feed's `since` is the cursor for
+the next request, until a feed has fewer entries than `limit`.
+
+Feeds can be revalidated with `If-None-Match` or `If-Modified-Since`: the
+ETag only depends on the newest entry of the feed, so unchanged feeds are
+answered with a 304 without loading their entries. Register the blueprint in
+your application::
+
+  app.register_blueprint(activity)
+
+URLs: `/activity/actors/<id>` and `/activity/objects/<class name>/<id>`, with
+optional `since`, `before` (older entries) and `limit` parameters.
+
+See: http://activitystrea.ms/specs/json/1.0/
+"""
+
+import json
+
+from flask import Blueprint, request, abort, make_response
+
+from yaka.core.entities import entity_class_by_name
+from yaka.core.subjects import User
+from yaka.services import activity_service
+from yaka.services.activity import PAGE_SIZE, load_objects
+
+
+activity = Blueprint("activity", __name__, url_prefix="/activity")
+
+#: Maximum number of entries per response.
+MAX_LIMIT = 200
+
+
+@activity.route("/actors/<int:user_id>")
+def actor_feed(user_id):
+  actor = User.query.get(user_id)
+  if actor is None:
+    abort(404)
+  return send_feed(activity_service.entries_for_actor, actor)
+
+
+@activity.route("/objects/<class_name>/<int:object_id>")
+def object_feed(class_name, object_id):
+  cls = entity_class_by_name(class_name)
+  if cls is None:
+    abort(404)
+  object = cls.query.get(object_id)
+  if object is None:
+    abort(404)
+  return send_feed(activity_service.entries_for_object, object)
+
+
+def send_feed(entries_for, target):
+  """Responds with the entries returned by `entries_for(target, ...)`, one
+  of the :class:`ActivityService` queries."""
+  limit = request.args.get('limit', PAGE_SIZE, type=int)
+  if not 0 < limit <= MAX_LIMIT:
+    abort(400)
+  since = request.args.get('since', type=int)
+  before = request.args.get('before', type=int)
+
+  response = make_response()
+  response.mimetype = "application/json"
+  response.cache_control.private = True
+  response.cache_control.max_age = 0
+  newest = entries_for(target, limit=1)
+  if newest:
+    newest = newest[0]
+    # Aggregated entries keep their id, but move to the top of the feed.
+    etag = "%d-%s" % (newest.id, newest.happened_at.isoformat())
+    # HTTP dates have a 1 second resolution.
+    last_modified = newest.happened_at.replace(microsecond=0)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    # When polling, the client may not have all the entries up to this one
+    # yet (pages of `limit` entries).
+    if ((since is None or since == newest.id)
+        and (request.if_none_match.contains(etag)
+             or (not request.if_none_match and request.if_modified_since
+                 and last_modified <= request.if_modified_since))):
+      response.status_code = 304
+      return response
+
+  entries = load_objects(entries_for(target, before=before, limit=limit,
+                                     since=since))
+  feed = dict(totalItems=len(entries),
+              items=[entry.to_dict() for entry in entries])
+  if entries and since is not None:
+    # Oldest first: cursor for the next request.
+    feed['since'] = entries[-1].id
+  elif entries:
+    # Cursors for the next poll, and for the next page.
+    feed['since'] = entries[0].id
+    feed['before'] = entries[-1].id
+  response.data = json.dumps(feed)
+  return response
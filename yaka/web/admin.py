@@ -0,0 +1,108 @@
+"""
+Admin views: technical information about the running services.
+
+The blueprint isn't registered by :class:`yaka.application.Application`:
+applications should register it behind their own access control, ex::
+
+  app.register_blueprint(admin)
+"""
+
+import csv
+import json
+from cStringIO import StringIO
+from datetime import datetime
+
+from flask import Blueprint, Response, jsonify, request, abort, \
+  stream_with_context
+
+from yaka.services import audit_service
+from yaka.services.audit import iter_entries
+from yaka.services.conversion import converter
+
+
+admin = Blueprint("admin", __name__, url_prefix="/admin")
+
+
+@admin.route("/conversion/stats")
+def conversion_stats():
+  """Metrics of the conversion service (cache hit ratios, per-handler
+  latencies, failures, bytes converted)."""
+  return jsonify(converter.stats.to_dict())
+
+
+@admin.route("/audit/recent")
+def recent_changes():
+  """Recent changes (audit entries) on all entities, most recent first.
+  Pass the `before` parameter (`next` in responses) to get older entries."""
+  before = request.args.get("before", type=int)
+  entries = audit_service.recent_entries(before=before)
+
+  result = []
+  for entry in entries:
+    d = entry.to_dict()
+    d['entity_class'] = entry.entity_class
+    d['entity_id'] = entry.entity_id
+    d['entity_url'] = entity_url(entry.entity)
+    result.append(d)
+
+  next = entries[-1].id if entries else None
+  return jsonify(entries=result, next=next)
+
+
+def entity_url(entity):
+  if entity is None:
+    return None
+  try:
+    return entity._url
+  except TypeError:
+    # No base_url: the entity isn't managed by a CRUD module.
+    return None
+
+
+EXPORT_COLUMNS = ['id', 'happened_at', 'type', 'user_id', 'entity_class',
+                  'entity_id', 'entity_name', 'changes']
+
+
+@admin.route("/audit/export")
+def export_audit():
+  """Streams audit entries, as CSV (`format=csv`, the default) or JSON lines
+  (`format=jsonl`). Filters: `entity_class`, `user_id`, `start` and `end`
+  (dates, YYYY-MM-DD; `end` excluded)."""
+  args = request.args
+  format = args.get("format", "csv")
+  if format not in ("csv", "jsonl"):
+    abort(400)
+  try:
+    start, end = [datetime.strptime(args[name], "%Y-%m-%d")
+                  if args.get(name) else None
+                  for name in ("start", "end")]
+  except ValueError:
+    abort(400)
+
+  entries = iter_entries(entity_class=args.get("entity_class") or None,
+                         user_id=args.get("user_id", type=int),
+                         start=start, end=end)
+  if format == "csv":
+    lines, mimetype = csv_lines(entries), "text/csv"
+  else:
+    lines, mimetype = (json.dumps(entry) + "\n" for entry in entries), \
+      "application/x-ndjson"
+
+  response = Response(stream_with_context(lines), mimetype=mimetype)
+  response.headers['Content-Disposition'] = \
+    'attachment; filename="audit.%s"' % format
+  return response
+
+
+def csv_lines(entries):
+  output = StringIO()
+  writer = csv.writer(output)
+  writer.writerow(EXPORT_COLUMNS)
+  for entry in entries:
+    entry['changes'] = json.dumps(entry['changes'])
+    writer.writerow([unicode(entry[name]).encode("utf8")
+                     if entry[name] is not None else ""
+                     for name in EXPORT_COLUMNS])
+    yield output.getvalue()
+    output.seek(0)
+    output.truncate()
@@ -152,6 +152,8 @@ class Module(object):
   name = None
   static_folder = None
   related_views = []
+  #: Number of audit entries shown on detail views (more can be loaded).
+  audit_page_size = 20
   search_criterions = (search.TextSearchCriterion("name",
                                                   attributes=('name', 'nom')),)
   _urls = []
@@ -433,14 +435,30 @@ class Module(object):
     rendered_entity = self.render_entity_view(entity)
     related_views = self.render_related_views(entity)
 
-    audit_entries = audit_service.entries_for(entity)
+    audit_entries, audit_more_url = self.audit_page(entity)
 
     return dict(rendered_entity=rendered_entity,
                 related_views=related_views,
                 audit_entries=audit_entries,
+                audit_more_url=audit_more_url,
                 breadcrumbs=bc,
                 module=self)
 
+  @expose("/<int:entity_id>/audit")
+  def entity_audit(self, entity_id):
+    """
+    JSON endpoint: audit entries of an entity, older than the `before` entry
+    ("load more" on detail views).
+    """
+    entity = self.managed_class.query.get(entity_id)
+    if entity is None:
+      abort(404)
+
+    before = request.args.get("before", type=int)
+    entries, more_url = self.audit_page(entity, before)
+    return jsonify(entries=[entry.to_dict() for entry in entries],
+                   more_url=more_url)
+
   @expose("/<int:entity_id>/edit")
   @templated("crm/single_view.html")
   def entity_edit(self, entity_id):
@@ -551,6 +569,18 @@ class Module(object):
   #
   # Utils
   #
+  def audit_page(self, entity, before=None):
+    """Returns a page of audit entries of `entity`, and the URL of the next
+    one (`None` if it is the last one)."""
+    entries = audit_service.entries_for(entity, before=before,
+                                        limit=self.audit_page_size + 1)
+    if len(entries) <= self.audit_page_size:
+      return entries, None
+
+    entries = entries[:self.audit_page_size]
+    more_url = "%s/%d/audit?before=%d" % (self.url, entity.id, entries[-1].id)
+    return entries, more_url
+
   def is_current(self):
     return request.path.startswith(self.url)
 
@@ -0,0 +1,78 @@
+"""
+Serves user and group photos, and their thumbnails.
+
+Photos are identified by their digest (`photo_digest`), which is used for
+ETags: revalidation doesn't load the photo itself, and thumbnails are cached
+by :mod:`yaka.services.image`. Register the blueprint in your application::
+
+  app.register_blueprint(photos)
+
+URLs: `/photos/users/<id>` and `/photos/groups/<id>`, with an optional `s`
+(size) parameter for square thumbnails.
+"""
+
+from flask import Blueprint, request, abort, make_response
+
+from yaka.core.extensions import db
+from yaka.core.subjects import User, Group, set_photo_digest
+from yaka.services import image
+
+
+photos = Blueprint("photos", __name__, url_prefix="/photos")
+
+#: Maximum thumbnail size (in pixels).
+MAX_SIZE = 500
+
+
+@photos.route("/users/<int:user_id>")
+def user_photo(user_id):
+  return send_photo(User, user_id)
+
+
+@photos.route("/groups/<int:group_id>")
+def group_photo(group_id):
+  return send_photo(Group, group_id)
+
+
+def send_photo(cls, id):
+  size = request.args.get('s', 0, type=int)
+  if not 0 <= size <= MAX_SIZE:
+    abort(400)
+
+  row = db.session.query(cls.photo_digest, cls.photo_updated_at)\
+    .filter(cls.id == id).first()
+  if row is None:
+    abort(404)
+  digest, updated_at = row
+  if digest is None:
+    # Photos stored before photo_digest was added (see also the
+    # UpdatePhotoDigests command).
+    photo = db.session.query(cls.photo).filter(cls.id == id).scalar()
+    if not photo:
+      abort(404)
+    digest, updated_at = set_photo_digest(cls, id, photo)
+    db.session.commit()
+  # HTTP dates have a 1 second resolution.
+  updated_at = updated_at.replace(microsecond=0)
+
+  format = image.negotiate_format() if size else None
+  etag = "%s-%d-%s" % (digest, size, format or "orig")
+
+  response = make_response()
+  response.set_etag(etag)
+  response.last_modified = updated_at
+  response.cache_control.public = True
+  response.cache_control.max_age = 0
+  response.vary.add("Accept")
+  if (request.if_none_match.contains(etag)
+      or (not request.if_none_match and request.if_modified_since
+          and updated_at <= request.if_modified_since)):
+    response.status_code = 304
+    return response
+
+  photo = db.session.query(cls.photo).filter(cls.id == id).scalar()
+  if size:
+    photo = image.crop_and_resize(photo, size, digest=digest, format=format)
+  response.data = photo
+  response.mimetype = image.mime_type(photo)
+  return response